@@ -0,0 +1,1433 @@
+"""
+Stores for the website's annotations (comments and keyboard flags).
+
+Two interchangeable backends, picked with HATPI_STORAGE_BACKEND:
+
+  json    comments.json / keyboard_flags.json held in memory with precomputed
+          indexes, re-read only when the files change. Writes append one
+          line to a journal beside the file, which is folded back into the
+          JSON file from time to time (python3 annotations.py compact).
+  sqlite  image_flags.db on a local disk is the primary store (WAL, indexed
+          on path, folder, night, IHU, flag and author); every write is one
+          short transaction. The JSON endpoints are generated from the
+          database.
+
+CLI (json backend):
+    python3 annotations.py compact FILE…   # fold FILE.journal into FILE
+"""
+
+import argparse
+import bisect
+import contextlib
+import fcntl
+import grp
+import json
+import logging
+import os
+import re
+import sqlite3
+import stat
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from file_index import describe_file, connect_shared, SHARED_GROUP
+
+HATPI_PREFIX = '/hatpi/'
+MARKUP_PREFIX = '/hatpi/markup_images/'
+
+IHU_RE = re.compile(r'^ihu-?(\d+)$')
+IHU_IN_NAME_RE = re.compile(r'ihu-?(\d+)')
+NIGHT_IN_NAME_RE = re.compile(r'1-\d{8}')
+
+# json backend journal: fsync each append ('always'), at most once per
+# JOURNAL_FSYNC_INTERVAL seconds ('interval'), or leave it to the OS ('never')
+JOURNAL_FSYNC = os.environ.get('HATPI_JOURNAL_FSYNC', 'always')
+JOURNAL_FSYNC_INTERVAL = 1.0
+# Fold the journal into the snapshot once it grows past this
+JOURNAL_COMPACT_BYTES = 256 * 1024
+# sqlite backend: WAL needs memory shared between the processes using the
+# database, so it only works on a local disk. A database that has to live on
+# NFS needs DELETE (a rollback journal) instead, and even then every process
+# writing to it must run on one host because NFS locking is unreliable.
+DB_JOURNAL_MODE = os.environ.get('HATPI_ANNOTATIONS_JOURNAL_MODE', 'WAL').upper()
+DB_JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST')
+
+
+def file_signature(path):
+    """(mtime_ns, size, inode) of path, or None when it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def folder_prefixes(folder):
+    """'RED/1-20250601/ihu02' → ['RED', 'RED/1-20250601', 'RED/1-20250601/ihu02']"""
+    parts = [p for p in folder.split('/') if p]
+    return ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+class JsonFileStore:
+    """
+    A JSON object file (the snapshot) plus an append-only journal beside it
+    (<file>.journal, one {"op": "set"|"del", "key": …, "value": …, "seq": N}
+    line per change), held in memory as the snapshot with the journal
+    replayed on top.
+
+    seq is the store's change version: it only grows, across workers and
+    compactions (a compacted journal starts with a {"op": "base", "seq": N}
+    line). changes_since() answers from the keys touched since the last
+    compaction; older versions get a reset.
+
+    refresh() costs two stat()s when nothing changed, and replays only the new
+    lines when just the journal grew. Writers hold an flock on <file>.lock
+    (honoured by every worker, over NFS too), append their lines and apply
+    them. Once the journal passes compact_bytes the writer folds it into a
+    new snapshot (atomic rename) and starts an empty journal. Replay is
+    idempotent, so a crash between those two steps loses nothing.
+
+    Readers use the current dict without locking: every change swaps in a
+    new one. Subclasses rebuild their indexes in _index().
+    """
+
+    def __init__(self, path, fsync=None, compact_bytes=None):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.fsync = fsync or JOURNAL_FSYNC
+        self.compact_bytes = compact_bytes or JOURNAL_COMPACT_BYTES
+        self.data = {}
+        self._snapshot_sig = None
+        self._journal_sig = None
+        self._journal_offset = 0   # bytes of the journal applied to self.data
+        self._last_fsync = 0.0
+        self.version = 0           # seq of the last change applied
+        self.base_version = 0      # version the snapshot was compacted at
+        self._changed = OrderedDict()   # key -> seq of its last change, oldest first
+        self._lock = threading.RLock()
+        self._index()
+
+    def refresh(self):
+        snapshot_sig, journal_sig = file_signature(self.path), file_signature(self.journal_path)
+        if (snapshot_sig, journal_sig) == (self._snapshot_sig, self._journal_sig):
+            return
+        with self._lock:
+            snapshot_sig, journal_sig = file_signature(self.path), file_signature(self.journal_path)
+            if (snapshot_sig, journal_sig) == (self._snapshot_sig, self._journal_sig):
+                return
+            if (snapshot_sig == self._snapshot_sig and journal_sig and self._journal_sig
+                    and journal_sig[2] == self._journal_sig[2]
+                    and journal_sig[1] >= self._journal_offset):
+                # Same snapshot, same journal, only appended to: replay the tail
+                before, data = self.data, dict(self.data)
+                offset, ops, version, base, touched = self._replay(data, self._journal_offset, self.version)
+                self.data, self._journal_offset = data, offset
+                self._index_ops(before, ops)
+            else:
+                data = self._read()
+                if data is None:
+                    return
+                offset, _, version, base, touched = self._replay(data, 0, 0)
+                self.data, self._journal_offset = data, offset
+                self._index()
+                base = base or 0
+            self._track(version, touched, base)
+            self._snapshot_sig, self._journal_sig = snapshot_sig, journal_sig
+
+    def _read(self):
+        """Parsed snapshot, {} when missing, None when unreadable (keep what we had)."""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("Error loading %s: %s" % (self.path, e))
+            return None
+        if not isinstance(data, dict):
+            logging.error("Error loading %s: not a JSON object" % self.path)
+            return None
+        return data
+
+    def _replay(self, data, offset, version):
+        """
+        Apply journal lines from *offset* to *data*, counting versions up
+        from *version*. Returns the offset just past the last complete line
+        (a half-written last line waits for the next refresh), the operations
+        applied, the resulting version, the base version if a base line was
+        read (else None) and [(key, seq)] touched.
+        """
+        ops, touched, base = [], [], None
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return 0, ops, version, base, touched
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.error("Skipping unreadable line in %s: %r" % (self.journal_path, line[:200]))
+                continue
+            if entry.get('op') == 'base':
+                version = base = entry.get('seq', version)
+                continue
+            # Journals written before versions existed have no seq
+            version = entry.get('seq') or version + 1
+            op = (entry.get('op'), entry.get('key'), entry.get('value'))
+            apply_op(data, *op)
+            ops.append(op)
+            touched.append((op[1], version))
+        return offset + end, ops, version, base, touched
+
+    def _track(self, version, touched, base=None):
+        """Record applied changes; a base version starts a fresh history."""
+        if base is not None:
+            self.base_version, self._changed = base, OrderedDict()
+        for key, seq in touched:
+            self._changed.pop(key, None)
+            self._changed[key] = seq
+        self.version = version
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, 'a') as lock_file:
+            make_group_writable(lock_file.fileno())
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sync(self, fd, force=False):
+        now = time.time()
+        if (force or self.fsync == 'always'
+                or (self.fsync == 'interval' and now - self._last_fsync >= JOURNAL_FSYNC_INTERVAL)):
+            os.fsync(fd)
+            self._last_fsync = now
+
+    def write(self, ops):
+        """
+        Journal and apply [(op, key, value)]: 'set' stores value under key,
+        'del' drops key. *ops* may also be a function of the current data
+        returning that list, for changes that depend on it; it runs under
+        the lock. Deletes of absent keys are skipped. Returns the number of
+        operations applied.
+        """
+        with self._lock, self._file_lock():
+            self.refresh()
+            if callable(ops):
+                ops = ops(self.data)
+            ops = [op for op in ops if op[0] != 'del' or op[1] in self.data]
+            if not ops:
+                return 0
+            seqs = range(self.version + 1, self.version + 1 + len(ops))
+            payload = b''.join(json.dumps(journal_entry(*op, seq=seq)).encode('utf-8') + b'\n'
+                               for op, seq in zip(ops, seqs))
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                make_group_writable(fd)
+                if os.fstat(fd).st_size > self._journal_offset:
+                    # Someone died mid-line; end it so ours parses on its own
+                    payload = b'\n' + payload
+                os.write(fd, payload)
+                self._sync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            before, data = self.data, dict(self.data)
+            for op in ops:
+                apply_op(data, *op)
+            self.data, self._journal_offset = data, size
+            self._journal_sig = file_signature(self.journal_path)
+            self._index_ops(before, ops)
+            self._track(seqs[-1], [(op[1], seq) for op, seq in zip(ops, seqs)])
+            if size >= self.compact_bytes:
+                self._compact()
+            return len(ops)
+
+    def compact(self):
+        """Fold the journal into the snapshot now."""
+        with self._lock, self._file_lock():
+            self.refresh()
+            self._compact()
+
+    def _compact(self):
+        """Caller holds both locks and has refreshed."""
+        header = json.dumps({'op': 'base', 'seq': self.version}) + '\n'
+        self._replace(self.path, json.dumps(self.data, indent=4))
+        self._replace(self.journal_path, header)
+        self._snapshot_sig = file_signature(self.path)
+        self._journal_sig = file_signature(self.journal_path)
+        self._journal_offset = len(header.encode('utf-8'))
+        self._track(self.version, [], base=self.version)
+
+    def _replace(self, path, text):
+        """Atomically replace path with text, keeping its permissions, group-writable."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+            f.flush()
+            self._sync(f.fileno(), force=self.fsync != 'never')
+            try:
+                old = os.stat(path)
+            except OSError:
+                old = None
+            if old is not None:
+                # Keep the old file's permissions (other tools write these too)
+                try:
+                    os.fchmod(f.fileno(), stat.S_IMODE(old.st_mode))
+                except OSError:
+                    pass
+            make_group_writable(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _index(self):
+        pass
+
+    def _index_ops(self, before, ops):
+        """Bring indexes up to date after *ops* turned *before* into self.data."""
+        self._index()
+
+    def current_version(self):
+        self.refresh()
+        return self.version
+
+    def changes_since(self, version):
+        """
+        {'version', 'changed': {key: value}, 'deleted': [keys], 'reset'}
+        for everything changed after *version*. When the history no longer
+        reaches back that far, reset is True and changed holds every entry.
+        """
+        self.refresh()
+        with self._lock:
+            data, current = self.data, self.version
+            if version < self.base_version or version > current:
+                return {'version': current, 'changed': dict(data), 'deleted': [], 'reset': True}
+            keys = []
+            for key, seq in reversed(self._changed.items()):
+                if seq <= version:
+                    break
+                keys.append(key)
+        return {'version': current, 'reset': False,
+                'changed': {k: data[k] for k in reversed(keys) if k in data},
+                'deleted': [k for k in reversed(keys) if k not in data]}
+
+    def signature(self):
+        """Changes whenever the snapshot or the journal does."""
+        self.refresh()
+        return [self._snapshot_sig, self._journal_sig]
+
+    def stats(self):
+        return {'path': self.path, 'entries': len(self.data), 'version': self.version,
+                'journal_bytes': self._journal_offset, 'fsync': self.fsync}
+
+
+def make_group_writable(fd):
+    """
+    Give the file behind *fd* to SHARED_GROUP, g+rw, if this process owns
+    it. The web workers and the ingest user's compaction both write the
+    snapshot, journal and lock files; without this whoever created one
+    (primary group, 022 umask) would be its only writer.
+    """
+    global _shared_gid
+    try:
+        st = os.fstat(fd)
+        if st.st_uid != os.geteuid():
+            return
+        if _shared_gid is None:
+            try:
+                _shared_gid = grp.getgrnam(SHARED_GROUP).gr_gid
+            except KeyError:
+                _shared_gid = -1
+        if st.st_mode & 0o060 != 0o060:
+            os.fchmod(fd, stat.S_IMODE(st.st_mode) | 0o060)
+        if _shared_gid != -1 and st.st_gid != _shared_gid:
+            os.fchown(fd, -1, _shared_gid)
+    except OSError as e:
+        # Most likely not a member of the group: say so once, not per write
+        logging.warning("Could not share fd %d with group %s: %s" % (fd, SHARED_GROUP, e))
+        _shared_gid = -1
+
+_shared_gid = None
+
+
+def journal_entry(op, key, value=None, seq=None):
+    entry = {'op': op, 'key': key}
+    if op == 'set':
+        entry['value'] = value
+    if seq is not None:
+        entry['seq'] = seq
+    return entry
+
+
+def apply_op(data, op, key, value=None):
+    if op == 'set':
+        data[key] = value
+    elif op == 'del':
+        data.pop(key, None)
+
+
+def comment_folder(file_path):
+    """'/hatpi/RED/1-20250601/ihu02/x.jpg' → 'RED/1-20250601/ihu02'"""
+    path = file_path or ''
+    if path.startswith(HATPI_PREFIX):
+        path = path[len(HATPI_PREFIX):]
+    return path.strip('/').rpartition('/')[0]
+
+
+def split_commented(file_paths):
+    """
+    (web paths without /hatpi, markup image names) for a set of commented
+    file_paths. Markup comments point at /hatpi/markup_images/<name>, so
+    those count for any file of that name.
+    """
+    web_paths, markup_names = set(), set()
+    for file_path in file_paths:
+        if file_path.startswith(MARKUP_PREFIX):
+            markup_names.add(file_path.rsplit('/', 1)[-1])
+        elif file_path.startswith(HATPI_PREFIX):
+            web_paths.add(file_path[len(HATPI_PREFIX) - 1:])
+    return web_paths, markup_names
+
+
+def comment_author(comment):
+    """Who wrote a comment; 'Unknown' when it was posted without an author."""
+    return comment.get('author') or 'Unknown'
+
+
+def group_by_author(comments):
+    """author → [comment_view, …] for (key, comment) pairs, order kept."""
+    grouped = {}
+    for key, comment in comments:
+        grouped.setdefault(comment_author(comment), []).append(comment_view(key, comment))
+    return grouped
+
+
+def comment_ihu(file_path):
+    """IHU a comment is about: an ihu-NN/ihuNN folder, else the filename's."""
+    folder, _, name = (file_path or '').rpartition('/')
+    for segment in folder.split('/'):
+        match = IHU_RE.match(segment)
+        if match:
+            return int(match.group(1))
+    return describe_file(folder, name)['ihu']
+
+
+def comment_night(file_path):
+    """'1-YYYYMMDD' night a comment's file belongs to, or None."""
+    match = NIGHT_IN_NAME_RE.search(file_path or '')
+    return match.group(0) if match else None
+
+
+def count_flags(items):
+    """{(night, ihu, flag): files} for (web_path, entry) pairs."""
+    counts = {}
+    for web_path, entry in items:
+        _, night, ihu = flag_columns(web_path)
+        for flag in entry.get('flags', ()):
+            counts[(night, ihu, flag)] = counts.get((night, ihu, flag), 0) + 1
+    return counts
+
+
+def count_comments(comments):
+    """{(author, night): comments} for comment dicts."""
+    counts = {}
+    for comment in comments:
+        key = (comment_author(comment), comment_night(comment.get('file_path')))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def in_nights(night, start, end):
+    """Whether *night* falls in [start, end] ('1-YYYYMMDD', either may be None)."""
+    if start is None and end is None:
+        return True
+    return night is not None and (start or '') <= night <= (end or '\uffff')
+
+
+def comment_sort_key(item):
+    """Newest first is reverse (timestamp, key): unique, so it pages cleanly."""
+    return (str(item[1].get('timestamp') or ''), item[0])
+
+
+def comment_view(key, comment):
+    """The shape index.html renders for one comment."""
+    return {
+        'unique_key': key,
+        'file_path': comment.get('file_path'),
+        'comment': comment.get('comment'),
+        'timestamp': comment.get('timestamp'),
+        'markup_true': comment.get('markup_true'),
+        'flags': comment.get('flags', []),
+    }
+
+
+class CommentStore(JsonFileStore):
+    """
+    comments.json, newest first: reverse (timestamp, key). Timestamps are
+    '%Y-%m-%d %H:%M:%S', which sorts correctly as a string, so no strptime
+    is needed.
+
+    Indexes (all lists of keys, newest first):
+      by_author   author → keys
+      by_path     file_path → keys
+      by_folder   every folder prefix under /hatpi/ → keys
+      by_ihu      IHU number → keys
+      timeline    (timestamp, key) ascending, for date-range bisects
+
+    counts holds comments per (author, night) for the aggregates endpoint.
+    Writes and journal replays that delete comments or add ones newer than
+    all the others (nearly all of them) update every index in place; any
+    other change re-sorts from scratch.
+    """
+
+    def _index(self):
+        ordered = sorted(self.data.items(), key=comment_sort_key, reverse=True)
+        comments = OrderedDict(ordered)
+        by_author, by_path, by_folder, by_ihu = {}, {}, {}, {}
+        for key, comment in ordered:
+            by_author.setdefault(comment_author(comment), []).append(key)
+            file_path = comment.get('file_path') or ''
+            by_path.setdefault(file_path, []).append(key)
+            for prefix in folder_prefixes(comment_folder(file_path)):
+                by_folder.setdefault(prefix, []).append(key)
+            ihu = comment_ihu(file_path)
+            if ihu is not None:
+                by_ihu.setdefault(ihu, []).append(key)
+        timeline = [comment_sort_key(item) for item in reversed(ordered)]
+        # Swap in one go so lock-free readers see a consistent set
+        (self.comments, self.by_author, self.by_path, self.by_folder, self.by_ihu,
+         self.timeline, self._grouped, self.commented, self.counts) = (
+            comments, by_author, by_path, by_folder, by_ihu, timeline,
+            group_by_author(ordered), split_commented(by_path),
+            count_comments(comments.values()))
+
+    def _index_ops(self, before, ops):
+        keys = list(dict.fromkeys(op[1] for op in ops))
+        removed = [(k, before[k]) for k in keys if k in before]
+        added = sorted(((k, self.data[k]) for k in keys if k in self.data), key=comment_sort_key)
+        if added:
+            gone = {k for k, _ in removed}
+            newest = next((item for item in reversed(self.timeline) if item[1] not in gone), None)
+            if newest is not None and comment_sort_key(added[0]) <= newest:
+                self._index()
+                return
+
+        # Work on copies of whatever changes, so lock-free readers see
+        # either all of this write or none of it
+        comments = OrderedDict(self.comments)
+        by_author, by_path, by_folder, by_ihu = (
+            dict(self.by_author), dict(self.by_path), dict(self.by_folder), dict(self.by_ihu))
+        grouped, counts, timeline = dict(self._grouped), dict(self.counts), list(self.timeline)
+
+        def entries(comment):
+            file_path = comment.get('file_path') or ''
+            found = [(by_author, comment_author(comment)), (by_path, file_path)]
+            found += [(by_folder, prefix) for prefix in folder_prefixes(comment_folder(file_path))]
+            ihu = comment_ihu(file_path)
+            if ihu is not None:
+                found.append((by_ihu, ihu))
+            return found
+
+        def count(comment, n):
+            count_key = (comment_author(comment), comment_night(comment.get('file_path')))
+            counts[count_key] = counts.get(count_key, 0) + n
+            if not counts[count_key]:
+                del counts[count_key]
+
+        for key, comment in removed:
+            del comments[key]
+            for index, name in entries(comment):
+                remaining = [k for k in index[name] if k != key]
+                if remaining:
+                    index[name] = remaining
+                else:
+                    del index[name]
+            author = comment_author(comment)
+            views = [v for v in grouped[author] if v['unique_key'] != key]
+            if views:
+                grouped[author] = views
+            else:
+                del grouped[author]
+            count(comment, -1)
+            del timeline[bisect.bisect_left(timeline, comment_sort_key((key, comment)))]
+        for key, comment in added:
+            comments[key] = comment
+            comments.move_to_end(key, last=False)
+            for index, name in entries(comment):
+                index[name] = [key] + index.get(name, [])
+            author = comment_author(comment)
+            grouped[author] = [comment_view(key, comment)] + grouped.get(author, [])
+            count(comment, 1)
+            timeline.append(comment_sort_key((key, comment)))
+
+        # Authors in order of their newest comment, as _index() has them
+        grouped = {author: grouped[author] for author in sorted(
+            grouped, key=lambda a: comment_sort_key((by_author[a][0], comments[by_author[a][0]])),
+            reverse=True)}
+        commented = self.commented
+        if by_path.keys() != self.by_path.keys():
+            commented = split_commented(by_path)
+        (self.comments, self.by_author, self.by_path, self.by_folder, self.by_ihu,
+         self.timeline, self._grouped, self.commented, self.counts) = (
+            comments, by_author, by_path, by_folder, by_ihu, timeline, grouped, commented, counts)
+
+    def all(self):
+        """Every comment, newest first. Treat as read-only."""
+        self.refresh()
+        return self.comments
+
+    def grouped_by_author(self):
+        """author → [comment_view, …] newest first, ready for index.html."""
+        self.refresh()
+        return self._grouped
+
+    def get(self, key):
+        self.refresh()
+        return self.comments.get(key)
+
+    def author_counts(self):
+        """author → number of comments."""
+        self.refresh()
+        return {author: len(keys) for author, keys in self.by_author.items()}
+
+    def comment_counts(self, start=None, end=None):
+        """[(author, night, comments)] for nights in [start, end]."""
+        self.refresh()
+        return [(author, night, n) for (author, night), n in self.counts.items()
+                if in_nights(night, start, end)]
+
+    def rebuild_counts(self):
+        """Recount from scratch (they are also rebuilt on every reload)."""
+        with self._lock:
+            self.refresh()
+            self.counts = count_comments(self.comments.values())
+
+    def for_author(self, author):
+        self.refresh()
+        return [(k, self.comments[k]) for k in self.by_author.get(author, ())]
+
+    def for_path(self, file_path):
+        self.refresh()
+        return [(k, self.comments[k]) for k in self.by_path.get(file_path, ())]
+
+    def for_folder(self, folder):
+        self.refresh()
+        return [(k, self.comments[k]) for k in self.by_folder.get(folder.strip('/'), ())]
+
+    def between(self, start=None, end=None):
+        """Comments with start <= timestamp <= end (either bound optional), newest first."""
+        self.refresh()
+        timeline = self.timeline
+        lo = bisect.bisect_left(timeline, (start,)) if start else 0
+        hi = bisect.bisect_right(timeline, (end + '\uffff',)) if end else len(timeline)
+        return [(k, self.comments[k]) for _, k in reversed(timeline[lo:hi])]
+
+    def query(self, author=None, folder=None, ihu=None, start=None, end=None,
+              before=None, limit=None):
+        """
+        Comments matching every given filter, newest first: (total matching,
+        [(key, comment)] of at most *limit* older than the cursor *before*,
+        a (timestamp, key) pair). start/end bound the timestamp like between().
+        """
+        self.refresh()
+        comments = self.comments
+        lists = []
+        if author is not None:
+            lists.append(self.by_author.get(author, []))
+        if folder is not None:
+            lists.append(self.by_folder.get(folder.strip('/'), []))
+        if ihu is not None:
+            lists.append(self.by_ihu.get(int(ihu), []))
+        if lists:
+            lists.sort(key=len)
+            others = [set(keys) for keys in lists[1:]]
+            keys = [k for k in lists[0] if all(k in other for other in others)]
+        else:
+            keys = list(comments)
+        if start or end:
+            high = (end or '\uffff') + '\uffff'
+            keys = [k for k in keys
+                    if (start or '') <= str(comments[k].get('timestamp') or '') <= high]
+        total = len(keys)
+        if before is not None:
+            before = tuple(before)
+            keys = [k for k in keys if comment_sort_key((k, comments[k])) < before]
+        if limit is not None:
+            keys = keys[:limit]
+        return total, [(k, comments[k]) for k in keys]
+
+    def paths(self):
+        """Every file_path that has at least one comment."""
+        self.refresh()
+        return self.by_path.keys()
+
+    def commented_paths(self):
+        """(web paths without /hatpi, markup image names) that have comments."""
+        self.refresh()
+        return self.commented
+
+    def add(self, key, comment):
+        self.write([('set', key, comment)])
+
+    def delete(self, key):
+        """True when the comment existed."""
+        return self.write([('del', key)]) > 0
+
+
+def flag_tokens(web_path):
+    """
+    Everything a flag entry can be looked up by. For
+    "/RED/1-20250313/ihu01/1-505238_01-red-twilight-bin4.jpg":
+      'RED', 'RED/1-20250313', 'RED/1-20250313/ihu01'   (folder prefixes)
+      '1-20250313', 'ihu01'                             (bare segments)
+      ('ihu', 1)                                        (either spelling)
+    Night dates and "ihu-NN" inside the filename count too, matching the
+    substring checks the folder pages used to do.
+    """
+    folder, _, name = web_path.strip('/').rpartition('/')
+    tokens = set(folder_prefixes(folder))
+    for segment in folder.split('/'):
+        if not segment:
+            continue
+        tokens.add(segment)
+        match = IHU_RE.match(segment)
+        if match:
+            tokens.add(('ihu', int(match.group(1))))
+    tokens.update(NIGHT_IN_NAME_RE.findall(name))
+    for number in IHU_IN_NAME_RE.findall(name):
+        tokens.add(('ihu', int(number)))
+    return tokens
+
+
+FLAG_OPS = ('add', 'remove', 'set')
+
+
+def merge_flags(current, op, flags):
+    """Flags after applying op ('add', 'remove' or 'set') with *flags*; sorted, no duplicates."""
+    if op == 'add':
+        return sorted(set(current) | set(flags))
+    if op == 'remove':
+        return sorted(set(current) - set(flags))
+    if op == 'set':
+        return sorted(set(flags))
+    raise ValueError('Unknown flag operation %r' % op)
+
+
+def plan_flag_changes(changes, current_flags):
+    """
+    Fold [(web_path, op, flags)] into {web_path: resulting flags}, starting
+    from current_flags(web_path). Later changes see earlier ones.
+    """
+    state = {}
+    for web_path, op, flags in changes:
+        current = state[web_path] if web_path in state else current_flags(web_path)
+        state[web_path] = merge_flags(current, op, flags)
+    return state
+
+
+def flag_view(web_path, entry):
+    """The shape folder.html renders for one flagged file."""
+    return {
+        'file_path': web_path,
+        'flags': entry.get('flags', []),
+        'timestamp': entry.get('timestamp', ''),
+        'author': entry.get('author', ''),
+    }
+
+
+class FlagStore(JsonFileStore):
+    """
+    keyboard_flags.json ("/RED/1-…/ihu01/….jpg" → {flags, timestamp, author}),
+    indexed by the tokens flag_tokens() yields so a folder page costs
+    O(flags in that folder). Lists keep file order. counts holds files per
+    (night, ihu, flag), kept up to date write by write.
+    """
+
+    def _index(self):
+        by_token = {}
+        for web_path in self.data:
+            for token in flag_tokens(web_path):
+                by_token.setdefault(token, []).append(web_path)
+        self.by_token, self.counts = by_token, count_flags(self.data.items())
+
+    def _index_ops(self, before, ops):
+        # Only added or removed paths move in the index; copy each touched
+        # list once so lock-free readers never see one change half-applied
+        by_token, copied, counts = dict(self.by_token), set(), dict(self.counts)
+        for web_path in dict.fromkeys(op[1] for op in ops):
+            for sign, entry in ((-1, before.get(web_path)), (1, self.data.get(web_path))):
+                for key, n in count_flags([(web_path, entry or {})]).items():
+                    counts[key] = counts.get(key, 0) + sign * n
+                    if not counts[key]:
+                        del counts[key]
+            added, removed = web_path in self.data, web_path in before
+            if added == removed:
+                continue
+            for token in flag_tokens(web_path):
+                if token not in copied:
+                    by_token[token] = list(by_token.get(token, ()))
+                    copied.add(token)
+                if added:
+                    by_token[token].append(web_path)
+                else:
+                    by_token[token].remove(web_path)
+        self.by_token, self.counts = by_token, counts
+
+    def all(self):
+        """web path → entry, in file order. Treat as read-only."""
+        self.refresh()
+        return self.data
+
+    def get(self, web_path):
+        self.refresh()
+        return self.data.get(web_path)
+
+    def lookup(self, web_paths):
+        """{web path: entry} for those of *web_paths* that have flags."""
+        self.refresh()
+        data = self.data
+        return {p: data[p] for p in web_paths if p in data}
+
+    def paths(self):
+        """Every flagged web path (a keys view, so membership is O(1))."""
+        self.refresh()
+        return self.data.keys()
+
+    def _lookup(self, token):
+        data, by_token = self.data, self.by_token
+        return [flag_view(p, data[p]) for p in by_token.get(token, ()) if p in data]
+
+    def for_folder(self, folder):
+        """
+        Flagged entries under a page's folder: a date folder ("1-20250313",
+        which includes its RED/SUB nights), "RED", "RED/1-20250313", or an
+        IHU folder in either spelling.
+        """
+        self.refresh()
+        folder = folder.strip('/')
+        match = IHU_RE.match(folder)
+        if match:
+            return self._lookup(('ihu', int(match.group(1))))
+        return self._lookup(folder)
+
+    def for_ihu(self, number):
+        self.refresh()
+        return self._lookup(('ihu', int(number)))
+
+    def flag_counts(self, start=None, end=None):
+        """[(night, ihu, flag, files)] for nights in [start, end]."""
+        self.refresh()
+        return [key + (n,) for key, n in self.counts.items() if in_nights(key[0], start, end)]
+
+    def rebuild_counts(self):
+        """Recount from scratch (they are also rebuilt on every reload)."""
+        with self._lock:
+            self.refresh()
+            self.counts = count_flags(self.data.items())
+
+    def update_many(self, changes, timestamp, author):
+        """
+        Apply [(web_path, op, flags)] in one journal append. Only paths whose
+        flags actually change are written. Returns {web_path: flags after}.
+        """
+        result = {}
+
+        def plan(data):
+            state = plan_flag_changes(changes, lambda p: (data.get(p) or {}).get('flags', []))
+            result.update(state)
+            ops = []
+            for web_path, flags in state.items():
+                old = data.get(web_path)
+                if flags and (old is None or old.get('flags') != flags):
+                    ops.append(('set', web_path, {'flags': flags, 'timestamp': timestamp, 'author': author}))
+                elif not flags and old is not None:
+                    ops.append(('del', web_path))
+            return ops
+
+        self.write(plan)
+        return result
+
+    def set_flags(self, web_path, flags, timestamp, author):
+        """Store flags for one file (dropping the entry when flags is empty)."""
+        if flags:
+            self.write([('set', web_path, {'flags': flags, 'timestamp': timestamp, 'author': author})])
+        else:
+            self.write([('del', web_path)])
+
+
+# --------------------------------------------------------------------------
+# SQLite backend
+# --------------------------------------------------------------------------
+
+def flag_columns(web_path):
+    """(folder, night, ihu) columns for a flag entry; see flag_tokens()."""
+    folder, _, name = web_path.strip('/').rpartition('/')
+    night = ihu = None
+    for segment in folder.split('/'):
+        if night is None and NIGHT_IN_NAME_RE.fullmatch(segment):
+            night = segment
+        match = IHU_RE.match(segment)
+        if ihu is None and match:
+            ihu = int(match.group(1))
+    if night is None:
+        match = NIGHT_IN_NAME_RE.search(name)
+        night = match.group(0) if match else None
+    if ihu is None:
+        match = IHU_IN_NAME_RE.search(name)
+        ihu = int(match.group(1)) if match else None
+    return folder, night, ihu
+
+
+def folder_range(folder):
+    """WHERE-clause arguments matching folder itself or anything under it."""
+    return (folder, folder + '/', folder + '0')   # '0' sorts right after '/'
+
+
+class AnnotationsDB:
+    """
+    SQLite home for flags and comments. One connection per thread (and per
+    process, since gunicorn forks after import). Every write runs in
+    transaction(), which bumps meta.version; readers compare that version to
+    know when their memoized views are stale, and changes records the
+    version that last touched each key for changes_since(). WAL needs every
+    writer on one host, which holds for the gunicorn workers.
+
+    image_flags keeps the columns scripts/sync_flags_to_db.py always wrote
+    (file_path, flags as JSON text, timestamp, author); older databases get
+    the lookup columns added and backfilled on first open.
+
+    flag_counts and comment_counts are counters the stores adjust in the
+    same transaction as each write. Unknown nights are '' and unknown IHUs 0
+    there, since primary key columns can't usefully hold NULL.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS image_flags (
+            file_path TEXT PRIMARY KEY,
+            flags     TEXT NOT NULL,
+            timestamp TEXT,
+            author    TEXT,
+            folder    TEXT,
+            night     TEXT,
+            ihu       INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS image_flag_names (
+            file_path TEXT NOT NULL,
+            flag      TEXT NOT NULL,
+            PRIMARY KEY (file_path, flag)
+        );
+        CREATE TABLE IF NOT EXISTS comments (
+            unique_key TEXT PRIMARY KEY,
+            file_path  TEXT,
+            folder     TEXT,
+            author     TEXT,
+            timestamp  TEXT,
+            data       TEXT NOT NULL,
+            ihu        INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS flag_counts (
+            night TEXT NOT NULL,
+            ihu   INTEGER NOT NULL,
+            flag  TEXT NOT NULL,
+            files INTEGER NOT NULL,
+            PRIMARY KEY (night, ihu, flag)
+        );
+        CREATE TABLE IF NOT EXISTS comment_counts (
+            author   TEXT NOT NULL,
+            night    TEXT NOT NULL,
+            comments INTEGER NOT NULL,
+            PRIMARY KEY (author, night)
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            store   TEXT NOT NULL,
+            key     TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (store, key)
+        );
+    """
+    INDEXES = """
+        CREATE UNIQUE INDEX IF NOT EXISTS image_flags_path ON image_flags (file_path);
+        CREATE INDEX IF NOT EXISTS image_flags_folder ON image_flags (folder);
+        CREATE INDEX IF NOT EXISTS image_flags_night ON image_flags (night);
+        CREATE INDEX IF NOT EXISTS image_flags_ihu ON image_flags (ihu);
+        CREATE INDEX IF NOT EXISTS image_flags_author ON image_flags (author);
+        CREATE INDEX IF NOT EXISTS image_flag_names_flag ON image_flag_names (flag, file_path);
+        CREATE INDEX IF NOT EXISTS comments_path ON comments (file_path);
+        CREATE INDEX IF NOT EXISTS comments_folder ON comments (folder);
+        CREATE INDEX IF NOT EXISTS comments_author ON comments (author, timestamp);
+        CREATE INDEX IF NOT EXISTS comments_timestamp ON comments (timestamp, unique_key);
+        CREATE INDEX IF NOT EXISTS comments_ihu ON comments (ihu, timestamp);
+        CREATE INDEX IF NOT EXISTS changes_version ON changes (store, version);
+    """
+
+    def __init__(self, db_path, journal_mode=None):
+        journal_mode = (journal_mode or DB_JOURNAL_MODE).upper()
+        if journal_mode not in DB_JOURNAL_MODES:
+            raise ValueError('Unknown journal mode %r (expected one of %s)' % (journal_mode, ', '.join(DB_JOURNAL_MODES)))
+        self.db_path = db_path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        self._migrated = False
+
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_shared(self.db_path, timeout=10)
+            conn.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._migrated:
+                self._migrate(conn)
+                self._migrated = True
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _migrate(self, conn):
+        conn.executescript(self.SCHEMA)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(image_flags)')}
+            for column, kind in (('folder', 'TEXT'), ('night', 'TEXT'), ('ihu', 'INTEGER')):
+                if column not in columns:
+                    conn.execute('ALTER TABLE image_flags ADD COLUMN %s %s' % (column, kind))
+            # Rows written by the old sync script have no lookup columns yet
+            if 'ihu' not in {row[1] for row in conn.execute('PRAGMA table_info(comments)')}:
+                conn.execute('ALTER TABLE comments ADD COLUMN ihu INTEGER')
+                for key, file_path in conn.execute('SELECT unique_key, file_path FROM comments').fetchall():
+                    conn.execute('UPDATE comments SET ihu = ? WHERE unique_key = ?', (comment_ihu(file_path), key))
+            # Comments posted without an author are filed under 'Unknown'
+            conn.execute("UPDATE comments SET author = 'Unknown' WHERE author IS NULL OR author = ''")
+            stale = conn.execute('SELECT file_path, flags FROM image_flags WHERE folder IS NULL').fetchall()
+            for file_path, flags in stale:
+                conn.execute('UPDATE image_flags SET folder = ?, night = ?, ihu = ? WHERE file_path = ?',
+                             flag_columns(file_path) + (file_path,))
+                conn.execute('DELETE FROM image_flag_names WHERE file_path = ?', (file_path,))
+                conn.executemany('INSERT OR IGNORE INTO image_flag_names (file_path, flag) VALUES (?, ?)',
+                                 [(file_path, flag) for flag in json.loads(flags or '[]')])
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            if not conn.execute("SELECT 1 FROM meta WHERE key = 'counts'").fetchone():
+                self.rebuild_counts(conn)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('counts', 1)")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.executescript(self.INDEXES)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """One IMMEDIATE transaction that bumps meta.version on commit."""
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._local.next_version = self.version() + 1
+            yield conn
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (self._local.next_version,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def record(self, conn, store, key):
+        """Note inside transaction() that *key* of *store* changed."""
+        conn.execute('INSERT INTO changes (store, key, version) VALUES (?, ?, ?)'
+                     ' ON CONFLICT (store, key) DO UPDATE SET version = excluded.version',
+                     (store, key, self._local.next_version))
+
+    def bump(self, conn, table, key, delta):
+        """Add *delta* to the counter row *key* of flag_counts/comment_counts."""
+        column = {'flag_counts': 'files', 'comment_counts': 'comments'}[table]
+        names = ('night', 'ihu', 'flag') if table == 'flag_counts' else ('author', 'night')
+        where = ' AND '.join('%s = ?' % name for name in names)
+        conn.execute('INSERT INTO %s (%s, %s) VALUES (%s, ?) ON CONFLICT (%s) DO UPDATE SET %s = %s + excluded.%s'
+                     % (table, ', '.join(names), column, ', '.join('?' * len(names)), ', '.join(names),
+                        column, column, column),
+                     tuple(key) + (delta,))
+        conn.execute('DELETE FROM %s WHERE %s AND %s <= 0' % (table, where, column), tuple(key))
+
+    def rebuild_counts(self, conn):
+        """Recount flag_counts and comment_counts inside a transaction."""
+        conn.execute('DELETE FROM flag_counts')
+        conn.execute("INSERT INTO flag_counts (night, ihu, flag, files)"
+                     " SELECT COALESCE(f.night, ''), COALESCE(f.ihu, 0), n.flag, COUNT(*)"
+                     " FROM image_flags f JOIN image_flag_names n ON n.file_path = f.file_path"
+                     " GROUP BY 1, 2, 3")
+        conn.execute('DELETE FROM comment_counts')
+        counts = count_comments({'author': author, 'file_path': file_path} for author, file_path
+                                in conn.execute('SELECT author, file_path FROM comments'))
+        conn.executemany('INSERT INTO comment_counts (author, night, comments) VALUES (?, ?, ?)',
+                         [(author, night or '', n) for (author, night), n in counts.items()])
+
+    def version(self):
+        row = self.conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def query(self, sql, args=()):
+        return self.conn().execute(sql, args).fetchall()
+
+
+def read_json_store(path):
+    """
+    Everything a json-backend store holds: the snapshot plus whatever is
+    still only in its journal. Reading the snapshot alone would lose every
+    write since the last compaction.
+    """
+    store = JsonFileStore(path)
+    store.refresh()
+    if store._snapshot_sig is None and os.path.exists(path):
+        raise ValueError("%s is not readable JSON" % path)
+    return dict(store.data)
+
+
+class SqliteStore:
+    """Shared plumbing: version-checked memoization of whole-table views."""
+
+    table = None
+
+    def __init__(self, db):
+        self.db = db
+        self._memo = {}
+
+    def signature(self):
+        return ('sqlite', self.db.version())
+
+    def _memoized(self, name, build):
+        version = self.db.version()
+        hit = self._memo.get(name)
+        if hit is not None and hit[0] == version:
+            return hit[1]
+        value = build()
+        self._memo[name] = (version, value)
+        return value
+
+    def count(self):
+        return self.db.query('SELECT COUNT(*) FROM %s' % self.table)[0][0]
+
+    def current_version(self):
+        return self.db.version()
+
+    def changes_since(self, version):
+        """Same shape as JsonFileStore.changes_since; the history never runs out."""
+        current = self.db.version()
+        if version > current:
+            return {'version': current, 'changed': dict(self.all()), 'deleted': [], 'reset': True}
+        keys = [row[0] for row in self.db.query(
+            'SELECT key FROM changes WHERE store = ? AND version > ? ORDER BY version',
+            (self.table, version))]
+        found = self.lookup(keys)
+        return {'version': current, 'reset': False,
+                'changed': {k: found[k] for k in keys if k in found},
+                'deleted': [k for k in keys if k not in found]}
+
+    def bootstrap(self, json_path):
+        """Seed an empty table from the json-backend files (journal included), once."""
+        if not os.path.exists(json_path) and not os.path.exists(json_path + '.journal'):
+            return 0
+        if self.count():
+            return 0
+        with self.db.transaction() as conn:
+            if conn.execute('SELECT 1 FROM %s LIMIT 1' % self.table).fetchone():
+                return 0
+            data = read_json_store(json_path)
+            for key, value in data.items():
+                self._upsert(conn, key, value)
+        logging.info("Imported %d entries from %s into %s" % (len(data), json_path, self.db.db_path))
+        return len(data)
+
+    def import_json(self, data):
+        """Upsert every entry of a legacy JSON dict in one transaction."""
+        with self.db.transaction() as conn:
+            for key, value in data.items():
+                self._upsert(conn, key, value)
+        return len(data)
+
+    def rebuild_counts(self):
+        """Recount the aggregate counters from the tables."""
+        with self.db.transaction() as conn:
+            self.db.rebuild_counts(conn)
+
+    def stats(self):
+        return {'path': self.db.db_path, 'journal_mode': self.db.journal_mode, 'entries': self.count(), 'version': self.db.version()}
+
+
+class SqliteCommentStore(SqliteStore):
+    """
+    Same interface as CommentStore. Each row keeps the comment's JSON as
+    posted (data) plus the indexed columns queries filter on.
+    """
+
+    table = 'comments'
+    ORDER = ' ORDER BY timestamp DESC, unique_key DESC'
+
+    def _count(self, conn, key, delta):
+        row = conn.execute('SELECT author, file_path FROM comments WHERE unique_key = ?', (key,)).fetchone()
+        if row:
+            self.db.bump(conn, 'comment_counts', (row[0] or 'Unknown', comment_night(row[1]) or ''), delta)
+
+    def _upsert(self, conn, key, comment):
+        self.db.record(conn, self.table, key)
+        self._count(conn, key, -1)
+        file_path = comment.get('file_path') or ''
+        conn.execute(
+            'INSERT INTO comments (unique_key, file_path, folder, author, timestamp, data, ihu)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (unique_key) DO UPDATE SET file_path = excluded.file_path,'
+            ' folder = excluded.folder, author = excluded.author,'
+            ' timestamp = excluded.timestamp, data = excluded.data, ihu = excluded.ihu',
+            (key, file_path, comment_folder(file_path), comment_author(comment),
+             str(comment.get('timestamp') or ''), json.dumps(comment), comment_ihu(file_path)))
+        self._count(conn, key, 1)
+
+    def _select(self, where='', args=(), limit=None):
+        sql = 'SELECT unique_key, data FROM comments' + where + self.ORDER
+        if limit is not None:
+            sql, args = sql + ' LIMIT ?', tuple(args) + (limit,)
+        return [(key, json.loads(data)) for key, data in self.db.query(sql, args)]
+
+    def query(self, author=None, folder=None, ihu=None, start=None, end=None,
+              before=None, limit=None):
+        """Same as CommentStore.query, as indexed SQL."""
+        clauses, args = [], []
+        if author is not None:
+            clauses.append('author = ?')
+            args.append(author)
+        if folder is not None:
+            clauses.append('(folder = ? OR (folder >= ? AND folder < ?))')
+            args.extend(folder_range(folder.strip('/')))
+        if ihu is not None:
+            clauses.append('ihu = ?')
+            args.append(int(ihu))
+        if start or end:
+            clauses.append('timestamp >= ? AND timestamp <= ?')
+            args.extend((start or '', (end or '\uffff') + '\uffff'))
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        total = self.db.query('SELECT COUNT(*) FROM comments' + where, args)[0][0]
+        if before is not None:
+            clauses.append('(timestamp < ? OR (timestamp = ? AND unique_key < ?))')
+            args.extend((before[0], before[0], before[1]))
+            where = ' WHERE ' + ' AND '.join(clauses)
+        return total, self._select(where, args, limit)
+
+    def all(self):
+        return self._memoized('all', lambda: OrderedDict(self._select()))
+
+    def grouped_by_author(self):
+        return self._memoized('grouped', lambda: group_by_author(self.all().items()))
+
+    def get(self, key):
+        rows = self._select(' WHERE unique_key = ?', (key,))
+        return rows[0][1] if rows else None
+
+    def lookup(self, keys):
+        """{key: comment} for those of *keys* that exist."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            found.update(self._select(' WHERE unique_key IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        return found
+
+    def author_counts(self):
+        return self._memoized('authors', lambda: dict(self.db.query(
+            "SELECT COALESCE(author, 'Unknown'), COUNT(*) FROM comments GROUP BY 1")))
+
+    def comment_counts(self, start=None, end=None):
+        where, args = '', ()
+        if start or end:
+            where, args = " WHERE night != '' AND night >= ? AND night <= ?", (start or '', end or '\uffff')
+        return [(author, night or None, n) for author, night, n in self.db.query(
+            'SELECT author, night, comments FROM comment_counts' + where, args)]
+
+    def for_author(self, author):
+        return self._select(' WHERE author = ?', (author,))
+
+    def for_path(self, file_path):
+        return self._select(' WHERE file_path = ?', (file_path,))
+
+    def for_folder(self, folder):
+        return self._select(' WHERE folder = ? OR (folder >= ? AND folder < ?)',
+                            folder_range(folder.strip('/')))
+
+    def between(self, start=None, end=None):
+        return self._select(' WHERE timestamp >= ? AND timestamp <= ?',
+                            (start or '', (end or '\uffff') + '\uffff'))
+
+    def paths(self):
+        return self._memoized('paths', lambda: {row[0] for row in self.db.query(
+            'SELECT DISTINCT file_path FROM comments')})
+
+    def commented_paths(self):
+        return self._memoized('commented', lambda: split_commented(self.paths()))
+
+    def add(self, key, comment):
+        with self.db.transaction() as conn:
+            self._upsert(conn, key, comment)
+
+    def delete(self, key):
+        with self.db.transaction() as conn:
+            self.db.record(conn, self.table, key)
+            self._count(conn, key, -1)
+            return conn.execute('DELETE FROM comments WHERE unique_key = ?', (key,)).rowcount > 0
+
+
+class SqliteFlagStore(SqliteStore):
+    """
+    Same interface as FlagStore. Flag names also live one per row in
+    image_flag_names so "every file flagged Trail" is an index lookup.
+    """
+
+    table = 'image_flags'
+
+    def _count(self, conn, web_path, delta):
+        _, night, ihu = flag_columns(web_path)
+        for (flag,) in conn.execute('SELECT flag FROM image_flag_names WHERE file_path = ?', (web_path,)).fetchall():
+            self.db.bump(conn, 'flag_counts', (night or '', ihu or 0, flag), delta)
+
+    def _upsert(self, conn, web_path, entry):
+        self.db.record(conn, self.table, web_path)
+        self._count(conn, web_path, -1)
+        flags = list(entry.get('flags', []))
+        conn.execute(
+            'INSERT INTO image_flags (file_path, flags, timestamp, author, folder, night, ihu)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (file_path) DO UPDATE SET flags = excluded.flags,'
+            ' timestamp = excluded.timestamp, author = excluded.author,'
+            ' folder = excluded.folder, night = excluded.night, ihu = excluded.ihu',
+            (web_path, json.dumps(flags), entry.get('timestamp', ''), entry.get('author', ''))
+            + flag_columns(web_path))
+        conn.execute('DELETE FROM image_flag_names WHERE file_path = ?', (web_path,))
+        conn.executemany('INSERT OR IGNORE INTO image_flag_names (file_path, flag) VALUES (?, ?)',
+                         [(web_path, flag) for flag in flags])
+        self._count(conn, web_path, 1)
+
+    def _delete(self, conn, web_path):
+        self.db.record(conn, self.table, web_path)
+        self._count(conn, web_path, -1)
+        conn.execute('DELETE FROM image_flag_names WHERE file_path = ?', (web_path,))
+        return conn.execute('DELETE FROM image_flags WHERE file_path = ?', (web_path,)).rowcount > 0
+
+    def _select(self, where='', args=()):
+        return self.db.query('SELECT file_path, flags, timestamp, author FROM image_flags'
+                             + where + ' ORDER BY rowid', args)
+
+    @staticmethod
+    def _entry(flags, timestamp, author):
+        return {'flags': json.loads(flags or '[]'), 'timestamp': timestamp or '', 'author': author or ''}
+
+    def all(self):
+        return self._memoized('all', lambda: {
+            path: self._entry(*rest) for path, *rest in self._select()})
+
+    def get(self, web_path):
+        rows = self._select(' WHERE file_path = ?', (web_path,))
+        return self._entry(*rows[0][1:]) if rows else None
+
+    def lookup(self, web_paths):
+        found = {}
+        web_paths = list(dict.fromkeys(web_paths))
+        for start in range(0, len(web_paths), 500):
+            chunk = web_paths[start:start + 500]
+            where = ' WHERE file_path IN (%s)' % ','.join('?' * len(chunk))
+            for path, *rest in self._select(where, chunk):
+                found[path] = self._entry(*rest)
+        return found
+
+    def paths(self):
+        return self.all().keys()
+
+    def _views(self, where, args):
+        return [flag_view(path, self._entry(*rest)) for path, *rest in self._select(where, args)]
+
+    def for_folder(self, folder):
+        folder = folder.strip('/')
+        match = IHU_RE.match(folder)
+        if match:
+            return self.for_ihu(match.group(1))
+        return self._views(' WHERE folder = ? OR (folder >= ? AND folder < ?) OR night = ?',
+                           folder_range(folder) + (folder,))
+
+    def for_ihu(self, number):
+        return self._views(' WHERE ihu = ?', (int(number),))
+
+    def flag_counts(self, start=None, end=None):
+        where, args = '', ()
+        if start or end:
+            where, args = " WHERE night != '' AND night >= ? AND night <= ?", (start or '', end or '\uffff')
+        return [(night or None, ihu or None, flag, n) for night, ihu, flag, n in self.db.query(
+            'SELECT night, ihu, flag, files FROM flag_counts' + where, args)]
+
+    def with_flag(self, flag):
+        """Web paths carrying *flag*."""
+        return [row[0] for row in self.db.query(
+            'SELECT file_path FROM image_flag_names WHERE flag = ? ORDER BY file_path', (flag,))]
+
+    def update_many(self, changes, timestamp, author):
+        """Same as FlagStore.update_many, in one transaction."""
+        with self.db.transaction() as conn:
+            def current(web_path):
+                row = conn.execute('SELECT flags FROM image_flags WHERE file_path = ?', (web_path,)).fetchone()
+                return json.loads(row[0] or '[]') if row else []
+            before = {}
+            state = plan_flag_changes(changes, lambda p: before.setdefault(p, current(p)))
+            for web_path, flags in state.items():
+                if flags and flags != before[web_path]:
+                    self._upsert(conn, web_path, {'flags': flags, 'timestamp': timestamp, 'author': author})
+                elif not flags and before[web_path]:
+                    self._delete(conn, web_path)
+        return state
+
+    def set_flags(self, web_path, flags, timestamp, author):
+        with self.db.transaction() as conn:
+            if flags:
+                self._upsert(conn, web_path, {'flags': flags, 'timestamp': timestamp, 'author': author})
+            else:
+                self._delete(conn, web_path)
+
+
+STORAGE_BACKENDS = ('json', 'sqlite')
+
+
+def open_stores(backend, comments_file, flags_file, db_path):
+    """(comment store, flag store) for HATPI_STORAGE_BACKEND *backend*."""
+    if backend == 'sqlite':
+        db = AnnotationsDB(db_path)
+        comments, flags = SqliteCommentStore(db), SqliteFlagStore(db)
+        comments.bootstrap(comments_file)
+        flags.bootstrap(flags_file)
+        return comments, flags
+    if backend != 'json':
+        raise ValueError('Unknown storage backend %r (expected one of %s)' % (backend, ', '.join(STORAGE_BACKENDS)))
+    return CommentStore(comments_file), FlagStore(flags_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the json-backend annotation files.")
+    parser.add_argument('command', choices=['compact'])
+    parser.add_argument('files', nargs='+', help="snapshot files, e.g. keyboard_flags.json")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    for path in args.files:
+        store = JsonFileStore(path)
+        store.refresh()
+        journal_bytes = store._journal_offset
+        store.compact()
+        print(json.dumps({'command': args.command, 'file': path, 'entries': len(store.data),
+                          'journal_bytes': journal_bytes}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
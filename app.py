@@ -1,40 +1,224 @@
-from flask import Flask, render_template, send_from_directory, send_file, request, jsonify, make_response, url_for
+from flask import Flask, Response, render_template, send_file, request, jsonify, make_response, url_for, abort, g
+from werkzeug.security import safe_join
 import os
 import datetime
 import json
 import logging
 import time
 import re
+import secrets
+import sys
 import threading
 import base64
+import bisect
 import hashlib
-from collections import OrderedDict
+import hmac
+import fcntl
+import gzip
+import zlib
+import mimetypes
+import sqlite3
+import stat
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from file_index import FileIndex, scan_folder, describe_file, connect_shared, share_with_group, KINDS
+try:
+    import brotli
+except ImportError:  # optional: without it the JSON files are offered gzipped only
+    brotli = None
+from annotations import open_stores, flag_view, comment_view, comment_sort_key, FLAG_OPS
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
-BASE_DIR = '/nfs/hatops/ar0/hatpi-website'
+BASE_DIR = os.environ.get('HATPI_BASE_DIR', '/nfs/hatops/ar0/hatpi-website')
 EXCLUDE_FOLDERS = set(['fix_json', 'download_sandbox' ,'static', 'templates', 'images', '.git', '__pycache__', 'scripts', 'movies', 'logs', 'markup_images', 'SUB', 'RED', 'data', 'calframe_test', 'daily', 'systemd'])
 
 for folder in os.listdir(BASE_DIR):
     if folder.startswith('ihu'):
         EXCLUDE_FOLDERS.add(folder)
 
-COMMENTS_FILE = '/nfs/hatops/ar0/hatpi-website/comments.json'
-SAVE_PATH = '/nfs/hatops/ar0/hatpi-website/markup_images'
-KEYBOARD_FLAGS_FILE = '/nfs/hatops/ar0/hatpi-website/keyboard_flags.json'
+COMMENTS_FILE = os.path.join(BASE_DIR, 'comments.json')
+SAVE_PATH = os.path.join(BASE_DIR, 'markup_images')
+KEYBOARD_FLAGS_FILE = os.path.join(BASE_DIR, 'keyboard_flags.json')
+# Where flags and comments live: 'json' (the two files above) or 'sqlite'
+# (ANNOTATIONS_DB is the primary store, seeded from the JSON files when empty,
+# and the .json endpoints are generated from it). Every worker writing to the
+# database must run on the same host, and the database must sit on a local
+# disk: WAL mode relies on shared memory and SQLite locking is unreliable over
+# NFS. LOCAL_DATA_DIR is persistent, unlike LOCAL_CACHE_DIR; create it once
+# with install -d -m 2775 -g hatuser. If the database has to live on NFS
+# after all, set HATPI_ANNOTATIONS_JOURNAL_MODE=DELETE (see annotations.py).
+STORAGE_BACKEND = os.environ.get('HATPI_STORAGE_BACKEND', 'json')
+LOCAL_DATA_DIR = os.environ.get('HATPI_DATA_DIR', '/var/lib/hatpi-website')
+ANNOTATIONS_DB = os.environ.get('HATPI_ANNOTATIONS_DB', os.path.join(LOCAL_DATA_DIR, 'image_flags.db'))
+# Upper bound on paths per POST /api/keyboard_flags/lookup and per batch update
+FLAG_LOOKUP_MAX_PATHS = 1000
+FLAG_BATCH_MAX_PATHS = 5000
+# Comments shown per author card on the home page; the rest load on scroll
+HOME_COMMENTS_PER_AUTHOR = 10
+COMMENTS_PAGE_DEFAULT = 20
+COMMENTS_PAGE_MAX = 200
+
+# Who streams image/movie/HTML bytes once a route has checked the path:
+#   'off'       the worker, with send_file (local runs, no proxy in front)
+#   'nginx'     nginx, via X-Accel-Redirect to FILE_OFFLOAD_PREFIX + real path.
+#               Needs: location /_hatpi_files/ { internal; alias /; }
+#   'sendfile'  Apache mod_xsendfile / lighttpd, via X-Sendfile: real path
+FILE_OFFLOAD = os.environ.get('HATPI_FILE_OFFLOAD', 'off')
+FILE_OFFLOAD_PREFIX = os.environ.get('HATPI_FILE_OFFLOAD_PREFIX', '/_hatpi_files')
+
+# Browser caching of a night's frames, movies and QA pages (see
+# file_cache_policy): final products are immutable, so a night viewed before
+# costs no requests at all; files of the last FINAL_AFTER_DAYS nights may
+# still be rewritten and are only kept for RECENT_MAX_AGE seconds.
+FINAL_AFTER_DAYS = 2
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+RECENT_MAX_AGE = 60
+# Written once and never again, whatever the night: RED/SUB frames
+FINAL_FILE_PATTERNS = (re.compile(r'^1-\d+_\d+-(red|sub)-.*\.jpg$'),)
+NIGHT_IN_PATH_RE = re.compile(r'1-(\d{8})')
+
+# Host-local scratch space shared by all gunicorn workers. Keep this off NFS:
+# SQLite locking is unreliable over network filesystems.
+LOCAL_CACHE_DIR = os.environ.get('HATPI_CACHE_DIR', '/tmp/hatpi-website-cache')
+SHARED_CACHE_DB = os.path.join(LOCAL_CACHE_DIR, 'listing_cache.db')
+FILE_INDEX_DB = os.path.join(LOCAL_CACHE_DIR, 'file_index.db')
+# Written by scripts/mark_changed.sh whenever the ingest pipeline touches a folder
+INVALIDATION_MANIFEST = os.path.join(LOCAL_CACHE_DIR, 'changed_folders.log')
+# The web workers and the ingest user (run_all.sh, mark_changed.sh,
+# file_index.py refresh) both write under LOCAL_CACHE_DIR: it is kept setgid
+# 2775 for this group and files in it are created group-writable, whoever
+# gets there first. Both users must be in the group.
+SHARED_GROUP = os.environ.get('HATPI_SHARED_GROUP', 'hatuser')
+
+# Listings are evicted through the invalidation manifest, so these only bound
+# how stale a folder can get if something writes to it without reporting it.
+ROOT_DIR_CACHE_TTL_SECONDS = 600
+FOLDER_CACHE_TTL_SECONDS = 600
+# After its TTL a folder listing may still be served for this long while it
+# is rescanned in the background (stale-while-revalidate). 0 disables it.
+FOLDER_CACHE_STALE_SECONDS = 1800
+# How long a request waits for another request's scan of the same folder
+# before giving up and scanning on its own
+SCAN_WAIT_SECONDS = 30
+SCAN_LOCK_DIR = os.path.join(LOCAL_CACHE_DIR, 'locks')
+# Warm-up after start and after each ingest: how many of the newest date
+# folders / RED-SUB nights to pre-scan, and with how many threads
+WARMUP_RECENT_DATES = 7
+WARMUP_THREADS = 4
+# POST /api/warmup must carry this file's secret in X-Warmup-Token. It is
+# made on first use, readable by SHARED_GROUP only; run_all.sh sends it.
+WARMUP_TOKEN_FILE = os.path.join(LOCAL_CACHE_DIR, 'warmup.token')
+# A reverse proxy on the same host makes every request look local; any of
+# these headers means the request came through one
+PROXY_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Forwarded-Host', 'X-Forwarded-Proto', 'X-Real-IP')
+# Per-worker budget for cached listings
+CACHE_MAX_BYTES = int(os.environ.get('HATPI_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+# File routes: request path → (real path, size, mtime) after following the
+# symlink chain, evicted with the listings. Paths that 404 are remembered
+# only briefly, so a file that appears without a manifest entry shows up soon.
+RESOLVED_PATH_CACHE_BYTES = 16 * 1024 * 1024
+RESOLVED_PATH_TTL_SECONDS = 600
+RESOLVED_PATH_NEGATIVE_TTL_SECONDS = 10
+# gzip/brotli copies of static assets, one per content hash, built once and
+# shared by every worker and restart
+STATIC_VARIANT_DIR = os.path.join(LOCAL_CACHE_DIR, 'static')
+STATIC_COMPRESS_TYPES = ('.js', '.css', '.html', '.svg', '.json', '.txt')
+STATIC_COMPRESS_MIN_BYTES = 1024
+# after_request compression of JSON/HTML responses: smaller bodies go out as
+# they are; results for responses with a strong ETag are kept per worker
+COMPRESS_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_GZIP_LEVEL = int(os.environ.get('HATPI_COMPRESS_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('HATPI_COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_CACHE_BYTES = 32 * 1024 * 1024
 
 logging.basicConfig(level=logging.DEBUG)
 
-# Generate cache-busting version at startup
-def generate_cache_version():
-    """Generate a unique version identifier for cache busting"""
-    timestamp = str(int(time.time()))
-    # Use a combination of timestamp and a hash of the main script
+# Group-writable files from here on (connect_shared does the same for SQLite
+# databases), then fix up what a 022 umask left behind.
+os.umask(0o002)
+for shared_dir in (LOCAL_CACHE_DIR, SCAN_LOCK_DIR):
     try:
-        with open(__file__, 'rb') as f:
-            script_hash = hashlib.md5(f.read()).hexdigest()[:8]
-    except:
-        script_hash = hashlib.md5(timestamp.encode()).hexdigest()[:8]
-    return f"{timestamp}_{script_hash}"
+        share_with_group(shared_dir, SHARED_GROUP)
+    except OSError as e:
+        logging.warning("Could not prepare %s: %s", shared_dir, e)
+
+class StaticAssets:
+    """
+    Content hashes and precompressed variants of the files under static/.
+
+    versioned_url_for() puts an asset's hash in ?v=, so its URL only changes
+    when its bytes do and custom_static can mark it immutable. gzip/brotli
+    variants are written once per hash under STATIC_VARIANT_DIR. Each lookup
+    costs one stat, so a file edited in place is rehashed on its next use.
+    """
+    def __init__(self, root, variant_dir):
+        self.root = root
+        self.variant_dir = variant_dir
+        self._assets = {}
+
+    def scan(self):
+        """Hash and precompress every asset now (at startup)."""
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                self.get(os.path.relpath(os.path.join(dirpath, name), self.root))
+        return self._assets
+
+    def get(self, filename):
+        """{'path', 'hash', 'variants': {encoding: path}} for an asset, or None."""
+        path = safe_join(self.root, filename)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        signature = (st.st_mtime_ns, st.st_size)
+        asset = self._assets.get(filename)
+        if asset is not None and asset['signature'] == signature:
+            return asset
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        asset = {'path': path, 'signature': signature, 'hash': digest,
+                 'variants': self._variants(filename, digest, data)}
+        self._assets[filename] = asset
+        return asset
+
+    def _variants(self, filename, digest, data):
+        stem, ext = os.path.splitext(os.path.basename(filename))
+        if ext.lower() not in STATIC_COMPRESS_TYPES or len(data) < STATIC_COMPRESS_MIN_BYTES:
+            return {}
+        encoders = {'gzip': ('.gz', lambda d: gzip.compress(d, 9, mtime=0))}
+        if brotli is not None:
+            encoders['br'] = ('.br', lambda d: brotli.compress(d, quality=11))
+        variants = {}
+        for encoding, (suffix, compress) in encoders.items():
+            variant = os.path.join(self.variant_dir, '%s.%s%s%s' % (stem, digest, ext, suffix))
+            if not os.path.exists(variant):
+                try:
+                    os.makedirs(self.variant_dir, exist_ok=True)
+                    tmp_path = '%s.%d.tmp' % (variant, os.getpid())
+                    with open(tmp_path, 'wb') as f:
+                        f.write(compress(data))
+                    os.replace(tmp_path, variant)
+                except OSError as e:
+                    logging.warning("Could not write %s: %s", variant, e)
+                    continue
+            variants[encoding] = variant
+        return variants
+
+    def version(self, filename):
+        asset = self.get(filename)
+        return asset['hash'] if asset else None
+
+static_assets = StaticAssets(app.static_folder, STATIC_VARIANT_DIR)
+
+def generate_cache_version():
+    """One version for the whole static/ tree; it only changes with the assets' content"""
+    assets = static_assets.scan()
+    combined = '\n'.join('%s %s' % (name, assets[name]['hash']) for name in sorted(assets))
+    return hashlib.sha256(combined.encode('utf-8')).hexdigest()[:16]
 
 # Global cache version - generated once at startup
 CACHE_VERSION = generate_cache_version()
@@ -43,12 +227,13 @@ logging.info(f"Cache-busting version generated: {CACHE_VERSION}")
 # Template function to add version to static URLs
 @app.template_global()
 def versioned_url_for(endpoint, **values):
-    """Generate URLs with cache-busting version parameter"""
+    """Generate URLs with a ?v= of the asset's content hash"""
     if endpoint == 'static':
         filename = values.get('filename', '')
         # Check if it's a CSS or JS file that needs versioning
-        if filename.endswith(('.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.ico')):
-            return f"/hatpi/static/{filename}?v={CACHE_VERSION}"
+        version = static_assets.version(filename) if filename.endswith(('.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.ico')) else None
+        if version:
+            return f"/hatpi/static/{filename}?v={version}"
         else:
             return f"/hatpi/static/{filename}"
     # For non-static endpoints, try to use url_for but fallback gracefully
@@ -67,62 +252,445 @@ def inject_cache_version():
 # Custom static file route - must be defined early to avoid conflicts with catch-all routes
 @app.route('/hatpi/static/<path:filename>')
 def custom_static(filename):
-    """Serve static files with proper cache control"""
+    """Serve static files with proper cache control, precompressed when accepted"""
+    asset = static_assets.get(filename)
+    if asset is None:
+        app.logger.error(f"Error serving static file {filename}: not found")
+        return "File not found", 404
+    # after_request makes it immutable when the URL names this exact content
+    g.static_immutable = request.args.get('v') == asset['hash']
     try:
-        return send_from_directory(app.static_folder, filename)
+        encoding = preferred_encoding([e for e in ('br', 'gzip') if e in asset['variants']])
+        if encoding:
+            response = send_file(asset['variants'][encoding],
+                                 mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = send_file(asset['path'])
     except Exception as e:
         app.logger.error(f"Error serving static file {filename}: {str(e)}")
         return "File not found", 404
+    if asset['variants']:
+        response.vary.add('Accept-Encoding')
+    return response
 
-class LRUCache:
-    def __init__(self, capacity=128):
-        self.cache = OrderedDict()
-        self.capacity = capacity
+def approx_size(value):
+    """Rough in-memory footprint of a cached value (containers, strings, numbers)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        size += sum(approx_size(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    return size
+
+class _CacheEntry:
+    __slots__ = ('value', 'size', 'expires_at', 'stale_until', 'last_used')
+
+    def __init__(self, value, size, expires_at, stale_until):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+        self.last_used = time.monotonic()
+
+class SizedTTLCache:
+    """
+    In-process cache bounded by approximate bytes rather than entry count.
+
+    Each entry has its own TTL and, optionally, a stale window after it during
+    which lookup() still returns the value flagged as stale so the caller can
+    serve it while revalidating. Reads take no lock: a dict lookup plus a
+    timestamp store are atomic under the GIL. Writes and eviction hold a
+    lock; eviction drops least-recently-used entries until the cache is back
+    under 90% of *max_bytes*. Counters are approximate under concurrency.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=600):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, key):
+        """Return (value, 'fresh' | 'stale') or (None, None)."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        now = time.monotonic()
+        if now < entry.expires_at:
+            entry.last_used = now
+            self.hits += 1
+            return entry.value, 'fresh'
+        if now < entry.stale_until:
+            entry.last_used = now
+            self.stale_hits += 1
+            return entry.value, 'stale'
+        self.misses += 1
+        self.expirations += 1
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._remove(key)
+        return None, None
 
     def get(self, key):
-        if key not in self.cache:
+        value, state = self.lookup(key)
+        return value if state == 'fresh' else None
+
+    def put(self, key, value, ttl=None, stale_ttl=0):
+        ttl = self.default_ttl if ttl is None else ttl
+        size = approx_size(key) + approx_size(value)
+        now = time.monotonic()
+        entry = _CacheEntry(value, size, now + ttl, now + ttl + stale_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict(self.max_bytes * 0.9)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _evict(self, target_bytes):
+        # Caller holds the lock
+        for key, _ in sorted(self._entries.items(), key=lambda kv: kv[1].last_used):
+            if self._bytes <= target_bytes:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._remove(key)
+            return entry.value
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def items(self):
+        """(key, value) pairs, expired ones included; counts as no lookup."""
+        return [(key, entry.value) for key, entry in list(self._entries.items())]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_rate': ((self.hits + self.stale_hits) / lookups) if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+cache = SizedTTLCache(max_bytes=CACHE_MAX_BYTES, default_ttl=FOLDER_CACHE_TTL_SECONDS)
+resolved_paths = SizedTTLCache(max_bytes=RESOLVED_PATH_CACHE_BYTES, default_ttl=RESOLVED_PATH_TTL_SECONDS)
+compressed_responses = SizedTTLCache(max_bytes=COMPRESS_CACHE_BYTES, default_ttl=FOLDER_CACHE_TTL_SECONDS)
+
+class SharedListingCache:
+    """
+    Folder listing cache shared by every gunicorn worker on this host.
+
+    Entries live in a SQLite file under LOCAL_CACHE_DIR and keep the same
+    (mtime, data, cached_at) layout as the in-process cache, so one scan per
+    folder change is enough for the whole server. Hit/miss counters are kept
+    per worker process.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect_shared(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS listings ('
+                ' path TEXT PRIMARY KEY,'
+                ' mtime REAL NOT NULL,'
+                ' data TEXT NOT NULL,'
+                ' cached_at REAL NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, mtime=None):
+        """
+        Return (mtime, data, cached_at) for *key*, or None.
+        When *mtime* is given, only an entry recorded for that mtime counts as a hit.
+        """
+        try:
+            row = self._conn().execute(
+                'SELECT mtime, data, cached_at FROM listings WHERE path = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.warning("SharedListingCache.get failed for %s: %s", key, e)
             return None
-        value = self.cache.pop(key)
-        self.cache[key] = value
-        return value
+        if row is None or (mtime is not None and row[0] != mtime):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], _tuplify(json.loads(row[1])), row[2]
+
+    def put(self, key, mtime, data, cached_at=None):
+        if cached_at is None:
+            cached_at = time.time()
+        try:
+            self._conn().execute(
+                'INSERT OR REPLACE INTO listings (path, mtime, data, cached_at) VALUES (?, ?, ?, ?)',
+                (key, mtime, json.dumps(data, separators=(',', ':')), cached_at),
+            )
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.warning("SharedListingCache.put failed for %s: %s", key, e)
 
-    def put(self, key, value):
-        if key in self.cache:
-            self.cache.pop(key)
-        elif len(self.cache) >= self.capacity:
-            self.cache.popitem(last=False)
-        self.cache[key] = value
+    def delete(self, key):
+        try:
+            self._conn().execute('DELETE FROM listings WHERE path = ?', (key,))
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.warning("SharedListingCache.delete failed for %s: %s", key, e)
 
     def clear(self):
-        self.cache.clear()
+        try:
+            self._conn().execute('DELETE FROM listings')
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.warning("SharedListingCache.clear failed: %s", e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': (self.hits / lookups) if lookups else None,
+        }
+
+def _tuplify(value):
+    """JSON turns our (name, date_str) tuples into lists; turn the leaf pairs back into tuples."""
+    if not isinstance(value, list):
+        return value
+    if value and not isinstance(value[0], list):
+        return tuple(value)
+    return [_tuplify(v) for v in value]
+
+shared_cache = SharedListingCache(SHARED_CACHE_DB)
+file_index = FileIndex(FILE_INDEX_DB)
+comment_store, flag_store = open_stores(STORAGE_BACKEND, COMMENTS_FILE, KEYBOARD_FLAGS_FILE, ANNOTATIONS_DB)
+
+def get_indexed_subfolders(folder_path):
+    """
+    Return (folder_mtime, [(name, ctime)]) for the child directories of
+    *folder_path*, answered from the persistent file index while the folder
+    mtime matches and rescanned (and re-indexed) otherwise.
+    Returns (None, None) if the folder is unreadable.
+    """
+    try:
+        folder_mtime = os.path.getmtime(folder_path)
+    except OSError:
+        return None, None
+    try:
+        subdirs = file_index.subfolders(folder_path, folder_mtime)
+        if subdirs is not None:
+            return folder_mtime, subdirs
+    except sqlite3.Error as e:
+        logging.warning("file index lookup failed for %s: %s", folder_path, e)
+    try:
+        images, html_files, movies, subdirs = scan_folder(folder_path)
+    except OSError as e:
+        logging.error("get_indexed_subfolders – error reading %s: %s", folder_path, e)
+        return None, None
+    try:
+        file_index.store(folder_path, folder_mtime, images, html_files, movies, subdirs)
+    except sqlite3.Error as e:
+        logging.warning("file index store failed for %s: %s", folder_path, e)
+    return folder_mtime, subdirs
 
-cache = LRUCache()
+def get_cached_subfolders(folder_path):
+    """
+    Like get_indexed_subfolders, but kept in the in-process cache so a hit
+    inside the TTL costs no stat at all. Cached under "<folder>/" so that
+    invalidating the folder drops it too.
+    """
+    key = folder_path + os.sep
+    entry = cache.get(key)
+    if entry:
+        return entry
+    folder_mtime, subdirs = get_indexed_subfolders(folder_path)
+    if subdirs is not None:
+        cache.put(key, (folder_mtime, subdirs), ttl=FOLDER_CACHE_TTL_SECONDS)
+    return folder_mtime, subdirs
+
+class InvalidationWatcher:
+    """
+    Tails the changed-folder manifest written by scripts/mark_changed.sh and
+    evicts just the folders listed there.
+
+    Each manifest line is "<epoch> <folder path>"; a path of "*" drops every
+    listing. The manifest is a local file and is stat'ed at most once per
+    *interval* seconds. If it is rotated or truncated we may have missed
+    lines, so everything is dropped once. *generation* names the manifest
+    position this worker has caught up to; it is the same in every worker
+    that has read the same lines, so it can go into ETags.
+    """
+    def __init__(self, manifest_path, interval=1.0):
+        self.manifest_path = manifest_path
+        self.interval = interval
+        self.evicted = 0
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        # Lines written before this worker started describe listings it
+        # never cached, so start reading from the current end of the file.
+        try:
+            st = os.stat(manifest_path)
+            self._inode, self._offset = st.st_ino, st.st_size
+        except OSError:
+            self._inode, self._offset = None, 0
+
+    def check(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.interval
+            try:
+                st = os.stat(self.manifest_path)
+            except OSError:
+                return
+            if self._inode is not None and (st.st_ino != self._inode or st.st_size < self._offset):
+                logging.info("Invalidation manifest rotated; dropping all cached listings")
+                self._inode, self._offset = st.st_ino, st.st_size
+                self._evict(['*'])
+                return
+            self._inode = st.st_ino
+            if st.st_size == self._offset:
+                return
+            with open(self.manifest_path, 'rb') as f:
+                f.seek(self._offset)
+                chunk = f.read(st.st_size - self._offset)
+            # Only consume complete lines; a partial one is picked up next time
+            end = chunk.rfind(b'\n') + 1
+            self._offset += end
+            folders = set()
+            for line in chunk[:end].decode('utf-8', 'replace').splitlines():
+                parts = line.strip().split(' ', 1)
+                if len(parts) == 2 and parts[1]:
+                    folders.add(parts[1])
+            if folders:
+                self._evict(folders)
+        finally:
+            self._lock.release()
+
+    def _evict(self, folders):
+        self.evicted += invalidate_folders(folders)
+
+    @property
+    def generation(self):
+        return '%x-%x' % (self._inode or 0, self._offset)
+
+    def stats(self):
+        return {'generation': self.generation, 'evicted': self.evicted}
+
+def invalidate_folders(folders):
+    """
+    Drop cached listings for *folders*, their parent folders (whose subfolder
+    lists may have changed) and anything cached beneath them. "*" drops
+    everything. Returns the number of in-process entries removed.
+    """
+    if '*' in folders:
+        removed = len(cache.keys())
+        cache.clear()
+        shared_cache.clear()
+        resolved_paths.clear()
+        return removed
+    folders = {os.path.normpath(f) for f in folders}
+    targets = folders | {os.path.dirname(f) for f in folders}
+    # Subfolder lists are cached under "<folder>/"
+    targets |= {t + os.sep for t in targets}
+    prefixes = tuple(f + os.sep for f in folders)
+    removed = 0
+    for key in cache.keys():
+        if key in targets or key.startswith(prefixes):
+            cache.pop(key)
+            removed += 1
+    for key in targets:
+        if not key.endswith(os.sep):
+            shared_cache.delete(key)
+    # Resolved files under the folders, by request path or by symlink target
+    for key, entry in resolved_paths.items():
+        if key.startswith(prefixes) or (entry and entry[0].startswith(prefixes)):
+            resolved_paths.pop(key)
+    logging.info("Invalidated %d cached listings for %s", removed, sorted(folders))
+    return removed
+
+invalidation_watcher = InvalidationWatcher(INVALIDATION_MANIFEST)
+
+@app.before_request
+def check_invalidations():
+    invalidation_watcher.check()
 
 def get_cached_dir_list(base_dir):
     """
     Return the list of (folder_name, creation_date_str) for BASE_DIR.
-    Uses a short TTL so new date folders appear without restarting the app.
+    New date folders are picked up through the invalidation manifest; the
+    TTL is only a backstop.
     """
-    ROOT_DIR_CACHE_TTL_SECONDS = 15
-
     cached_entry = cache.get(base_dir)  # cached_entry := (cached_at_epoch, folders)
     if cached_entry:
         try:
             cached_at, folders = cached_entry
-            if (time.time() - cached_at) < ROOT_DIR_CACHE_TTL_SECONDS:
-                return folders
+            return folders
         except Exception:
             # Fall through and rebuild cache on any unexpected structure
             pass
 
+    # Another worker may have listed BASE_DIR recently
+    shared_entry = shared_cache.get(base_dir)
+    if shared_entry:
+        _, folders, cached_at = shared_entry
+        remaining = ROOT_DIR_CACHE_TTL_SECONDS - (time.time() - cached_at)
+        if remaining > 0:
+            cache.put(base_dir, (cached_at, folders), ttl=remaining)
+            return folders
+
     folders = []
-    for folder in os.listdir(base_dir):
-        folder_path = os.path.join(base_dir, folder)
-        if os.path.isdir(folder_path) and folder not in EXCLUDE_FOLDERS:
-            creation_date = get_creation_date(folder_path)
+    for folder, ctime in get_indexed_subfolders(base_dir)[1] or []:
+        if folder not in EXCLUDE_FOLDERS:
+            if ctime is None:
+                # Symlinked folder: scan_folder doesn't follow those
+                creation_date = get_creation_date(os.path.join(base_dir, folder))
+            else:
+                creation_date = datetime.datetime.fromtimestamp(ctime).strftime('%Y-%m-%d %H:%M:%S')
             folders.append((folder, creation_date))
     folders.sort(key=lambda x: x[0], reverse=True)
-    cache.put(base_dir, (time.time(), folders))
+    cached_at = time.time()
+    cache.put(base_dir, (cached_at, folders), ttl=ROOT_DIR_CACHE_TTL_SECONDS)
+    shared_cache.put(base_dir, 0, folders, cached_at)
     return folders
 
 def format_folder_name(value):
@@ -270,49 +838,19 @@ def format_filename(value):
 app.jinja_env.filters['format_folder'] = format_folder_name
 app.jinja_env.filters['format_filename'] = format_filename
 
-previous_state = set()
-
-def poll_directory():
-    global previous_state
-    while True:
-        current_state = set()
-        for folder in os.listdir(BASE_DIR):
-            folder_path = os.path.join(BASE_DIR, folder)
-            if os.path.isdir(folder_path) and folder not in EXCLUDE_FOLDERS:
-                current_state.add(folder_path)
-
-        if current_state != previous_state:
-            cache.clear()
-            print("Cache cleared due to directory change")
-            previous_state = current_state
-        
-        time.sleep(1800)
-        
-def group_comments_by_author(comments):
-    grouped = {}
-    for key, comment in comments.items():
-        author = comment.get('author', 'Unknown')
-        if author not in grouped:
-            grouped[author] = []
-        grouped[author].append({
-            'unique_key': key,
-            'file_path': comment.get('file_path'),
-            'comment': comment.get('comment'),
-            'timestamp': comment.get('timestamp'),
-            'markup_true': comment.get('markup_true'),
-            'flags': comment.get('flags', []) #making sure to default to empty list if no flags tagged on image
-        })
-    return grouped
-
 @app.route('/')
 def home():
     start_time = time.time()
     folders = get_cached_dir_list(BASE_DIR)
-    comments = load_comments() or {}
-    comments_by_author = group_comments_by_author(comments)
-    logging.info("Rendering template with folders: %s and comments: %s" % (folders, comments))
+    # Only the first page per author; the cards fetch the rest from /api/comments
+    comments_by_author = {}
+    for author, total in comment_store.author_counts().items():
+        comments_by_author[author] = comments_page(total, comment_store.query(author=author, limit=HOME_COMMENTS_PER_AUTHOR + 1)[1],
+                                                   HOME_COMMENTS_PER_AUTHOR)
+    logging.info("Rendering template with %d folders and comments from %d authors" % (len(folders), len(comments_by_author)))
     logging.info("Home route processing time: %s seconds" % (time.time() - start_time))
-    return render_template('index.html', folders=folders, comments_by_author=comments_by_author)
+    return render_template('index.html', folders=folders, comments_by_author=comments_by_author,
+                           comments_per_author=HOME_COMMENTS_PER_AUTHOR)
 
 @app.route('/<folder_name>/')
 def folder(folder_name):
@@ -324,18 +862,7 @@ def folder(folder_name):
     # items via /api/folder with pagination.
     images, html_files, movies = [], [], []
 
-    keyboard_flags = load_keyboard_flags()
-    flagged_for_folder = []
-
-    # Correctly aligned for-loop:
-    for fullpath, flag_data in keyboard_flags.items():
-        if folder_name in fullpath:
-            flagged_for_folder.append({
-                "file_path": fullpath,
-                "flags": flag_data.get("flags", []),
-                "timestamp": flag_data.get("timestamp", ""),
-                "author": flag_data.get("author", "")
-            })
+    flagged_for_folder = flag_store.for_folder(folder_name)
 
     return render_template(
         'folder.html',
@@ -347,15 +874,141 @@ def folder(folder_name):
     )
 
 
+def listing_etag(folder_path, folder_mtime, extra=None):
+    """
+    Strong ETag for a listing response: the endpoint, the folder, the mtime
+    the cached listing was taken at, the invalidation generation and the
+    query parameters (plus *extra*, for responses that depend on more).
+    Identical in every worker for identical output.
+    """
+    args = sorted(request.args.items(multi=True))
+    raw = json.dumps([request.path, folder_path, folder_mtime, invalidation_watcher.generation, args, extra])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def not_modified_response(etag):
+    """
+    Return a 304 if the client already holds *etag*, else None. Weak
+    comparison, as If-None-Match calls for: a compressed copy goes out as
+    W/"<etag>" and must still revalidate.
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def with_etag(response, etag):
+    # no-cache: browsers may keep the body but must revalidate it with us
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def preferred_encoding(available):
+    """The encoding in *available* the client accepts with the highest q, or None."""
+    best, best_q = None, 0
+    for encoding in available:
+        q = request.accept_encodings[encoding]
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+class EncodedJSON:
+    """
+    One endpoint's JSON body, serialized once per change of its source and
+    kept as bytes, with gzip/brotli variants made on first request. *load*
+    returns (signature, data): the signature must change whenever the data
+    does (a stat of the backing files, a database version) so that a repeat
+    request costs the signature and a buffer write.
+    """
+    def __init__(self, load):
+        self.load = load
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """(etag, {encoding: bytes}) for the current data."""
+        signature = self.load(signature_only=True)
+        entry = self._entry
+        if entry is not None and entry[0] == signature:
+            return entry[1], entry[2]
+        with self._lock:
+            entry = self._entry
+            if entry is None or entry[0] != signature:
+                # Take the signature again with the data: it may have moved on
+                signature, data = self.load()
+                body = app.json.dumps(data, separators=(',', ':')).encode('utf-8') + b'\n'
+                entry = self._entry = (signature, hashlib.sha1(body).hexdigest(), {'identity': body})
+        return entry[1], entry[2]
+
+    def _encode(self, bodies, encoding):
+        encoded = bodies.get(encoding)
+        if encoded is None:
+            encoded = compress_body(bodies['identity'], encoding)
+            bodies[encoding] = encoded  # a race only means compressing twice
+        return encoded
+
+    def response(self):
+        etag, bodies = self.get()
+        encoding = preferred_encoding(('br', 'gzip') if brotli is not None else ('gzip',))
+        if encoding:
+            # Strong ETags name exact bytes, so each encoding gets its own
+            etag = '%s-%s' % (etag, encoding)
+        not_modified = not_modified_response(etag)
+        if not_modified is not None:
+            not_modified.vary.add('Accept-Encoding')
+            return not_modified
+        response = Response(self._encode(bodies, encoding) if encoding else bodies['identity'],
+                            mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return with_etag(response, etag)
+
 @app.route('/api/folder/<path:folder_name>')
 def api_folder(folder_name):
     folder_path = os.path.join(BASE_DIR, folder_name)
-    images, html_files, movies = get_cached_files(folder_path)
+    folder_mtime, (images, html_files, movies) = get_cached_listing(folder_path)
+
+    cursor_mode = 'cursor' in request.args
+    # has_flags/has_comments answers also depend on the flag and comment files
+    extra = annotations_version() if cursor_mode and (request.args.get('has_flags') or request.args.get('has_comments')) else None
+
+    # Answer revalidations before serializing anything
+    etag = listing_etag(folder_path, folder_mtime, extra)
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+    if cursor_mode:
+        try:
+            response = cursor_page_response(folder_name, folder_path, folder_mtime, (images, html_files, movies))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return with_etag(response, etag)
+    return with_etag(folder_listing_response(images, html_files, movies), etag)
+
+STREAM_BATCH_SIZE = 500
 
+def stream_listing_json(images, html_files, movies):
+    """
+    Yield {"html_files": [...], "images": [...], "movies": [...]} in chunks
+    straight from the cached lists, so big IHU folders never exist as one
+    serialized string. Output matches what jsonify() produced.
+    """
+    separators = (',', ':')
+    sections = (('html_files', html_files), ('images', images), ('movies', movies))
+    for n, (name, items) in enumerate(sections):
+        yield '%s"%s":[' % ('{' if n == 0 else '],', name)
+        for start in range(0, len(items), STREAM_BATCH_SIZE):
+            chunk = json.dumps(items[start:start + STREAM_BATCH_SIZE], separators=separators)[1:-1]
+            yield chunk if start == 0 else ',' + chunk
+    yield ']}\n'
+
+def folder_listing_response(images, html_files, movies):
     # Backward-compatible default: if no 'limit' provided, return full arrays
     limit_raw = request.args.get('limit')
     if not limit_raw:
-        return jsonify({'images': images, 'html_files': html_files, 'movies': movies})
+        return Response(stream_listing_json(images, html_files, movies), mimetype='application/json')
 
     # Pagination mode
     try:
@@ -410,153 +1063,475 @@ def api_folder(folder_name):
         }
     })
 
-def is_date_based_folder(folder_name):
-    return re.match(r'\d{4}-\d{2}-\d{2}', folder_name) is not None
-
-def extract_ihu_number(filename):
+# ---- Cursor pagination ------------------------------------------------------
+#
+# /api/folder/<folder>?cursor=[&kind=images][&limit=200]
+#     [&sort=name|date|ihu|frame][&order=asc|desc]
+#     [&subtype=twilight,object][&product=red|sub][&ihu=1,50]
+#     [&frame_from=N][&frame_to=N][&date_from=YYYYMMDD][&date_to=YYYYMMDD]
+#     [&has_flags=1][&has_comments=1]
+#
+# The cursor encodes the sort key of the last item returned, so the next
+# page starts right after it even if files were added or removed meanwhile.
+# It also names the kind, sort and order it was issued for; a cursor sent
+# back with different ones is rejected rather than compared against keys of
+# another shape.
+
+CURSOR_SORTS = {
+    'name':  lambda e: (),
+    'date':  lambda e: (e[1],),
+    'ihu':   lambda e: (e[2]['ihu'] if e[2]['ihu'] is not None else 999,),
+    'frame': lambda e: (e[2]['frame'] if e[2]['frame'] is not None else -1,),
+}
+# Element types of each sort's keys (the sort value, then the name)
+CURSOR_KEY_TYPES = {
+    'name':  (str,),
+    'date':  (str, str),
+    'ihu':   (int, str),
+    'frame': (int, str),
+}
+
+class FolderEntries:
     """
-    Pull the IHU index (1-64) out of any filename pattern we use:
-      • "…_51_…", "…_51.html", "…_51-calframe…"   (date folders)
-      • "…ihu-51-…", "…ihu-51_…"                   (ihu-## folders)
-    Returns the integer, or ∞ so non-matches drop to the end.
+    Per-entry metadata for one folder listing, computed once per listing
+    mtime, plus lazily built sorted views of it.
     """
-    match = re.search(r'(?:_|ihu-)(\d{1,2})(?:[_\.\-])', filename)
-    return int(match.group(1)) if match else float("inf")
+    def __init__(self, folder_path, listing):
+        # kind -> [(name, dt_str, meta)]
+        self.by_kind = {
+            kind: [(name, dt_str, describe_file(folder_path, name)) for name, dt_str in items]
+            for kind, items in zip(KINDS, listing)
+        }
+        self._views = {}
+
+    def __sizeof__(self):
+        # Lets approx_size() charge the cache for the metadata, not just the object
+        return object.__sizeof__(self) + approx_size(self.by_kind)
+
+    def sorted_view(self, kind, sort, descending):
+        """Return (keys, entries) for *kind* sorted by (sort key, name)."""
+        view_key = (kind, sort, descending)
+        view = self._views.get(view_key)
+        if view is None:
+            key_fn = CURSOR_SORTS[sort]
+            decorated = sorted(((key_fn(e) + (e[0],), e) for e in self.by_kind[kind]),
+                               key=lambda ke: ke[0], reverse=descending)
+            view = ([k for k, _ in decorated], [e for _, e in decorated])
+            self._views[view_key] = view
+        return view
+
+def get_folder_entries(folder_path, folder_mtime, listing):
+    key = 'entries:' + folder_path
+    cached = cache.get(key)
+    if cached and cached[0] == folder_mtime:
+        return cached[1]
+    entries = FolderEntries(folder_path, listing)
+    cache.put(key, (folder_mtime, entries), ttl=FOLDER_CACHE_TTL_SECONDS)
+    return entries
+
+def default_sort_for(folder_path):
+    # Same order the plain listing uses: date folders by IHU, the rest newest first
+    if re.match(re.escape(BASE_DIR) + r'/1-\d{8}$', folder_path):
+        return 'ihu', 'asc'
+    return 'date', 'desc'
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return tuple(json.loads(base64.urlsafe_b64decode(padded.encode('ascii'))))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+
+def decode_listing_cursor(cursor, kind, sort, order):
+    """The sort key in a cursor_page_response cursor, checked against the request."""
+    payload = decode_cursor(cursor)
+    if tuple(payload[:3]) != (kind, sort, order):
+        raise ValueError("cursor was issued for a different kind, sort or order")
+    key = payload[3:]
+    types = CURSOR_KEY_TYPES[sort]
+    if len(key) != len(types) or not all(type(v) is t for v, t in zip(key, types)):
+        raise ValueError("invalid cursor")
+    return key
+
+def _int_list_arg(name):
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    try:
+        return {int(v) for v in raw.split(',') if v}
+    except ValueError:
+        raise ValueError("%s must be a comma-separated list of integers" % name)
+
+def _int_arg(name):
+    raw = request.args.get(name)
+    if raw in (None, ''):
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError("%s must be an integer" % name)
+
+def _date_arg(name):
+    raw = (request.args.get(name) or '').replace('-', '')
+    if raw and not re.match(r'^\d{8}$', raw):
+        raise ValueError("%s must be YYYYMMDD or YYYY-MM-DD" % name)
+    return raw or None
+
+def build_entry_filter(folder_name):
+    """Turn the request's filter arguments into a predicate over (name, dt_str, meta)."""
+    subtypes = {v.lower() for v in request.args.get('subtype', '').split(',') if v}
+    product = (request.args.get('product') or '').lower() or None
+    ihus = _int_list_arg('ihu')
+    frame_from, frame_to = _int_arg('frame_from'), _int_arg('frame_to')
+    date_from, date_to = _date_arg('date_from'), _date_arg('date_to')
+    flagged = flagged_paths() if request.args.get('has_flags') else None
+    commented = commented_paths() if request.args.get('has_comments') else None
+    web_prefix = '/' + folder_name.strip('/') + '/'
+
+    def accept(entry):
+        name, _, meta = entry
+        if subtypes and meta['subtype'] not in subtypes:
+            return False
+        if product and meta['product'] != product:
+            return False
+        if ihus is not None and meta['ihu'] not in ihus:
+            return False
+        if frame_from is not None or frame_to is not None:
+            if meta['frame'] is None:
+                return False
+            if frame_from is not None and meta['frame'] < frame_from:
+                return False
+            if frame_to is not None and meta['frame'] > frame_to:
+                return False
+        if date_from or date_to:
+            if meta['night'] is None:
+                return False
+            if date_from and meta['night'] < date_from:
+                return False
+            if date_to and meta['night'] > date_to:
+                return False
+        if flagged is not None and web_prefix + name not in flagged:
+            return False
+        if commented is not None and web_prefix + name not in commented[0] and name not in commented[1]:
+            return False
+        return True
+
+    return accept
+
+def cursor_page_response(folder_name, folder_path, folder_mtime, listing):
+    kind = request.args.get('kind', 'images')
+    if kind not in KINDS:
+        raise ValueError("kind must be one of %s" % ', '.join(KINDS))
+    default_sort, default_order = default_sort_for(folder_path)
+    sort = request.args.get('sort', default_sort)
+    if sort not in CURSOR_SORTS:
+        raise ValueError("sort must be one of %s" % ', '.join(CURSOR_SORTS))
+    order = request.args.get('order', default_order)
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    try:
+        limit = max(1, min(1000, int(request.args.get('limit', 200))))
+    except ValueError:
+        limit = 200
+    accept = build_entry_filter(folder_name)
+
+    keys, entries = get_folder_entries(folder_path, folder_mtime, listing).sorted_view(kind, sort, order == 'desc')
+    start = 0
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_listing_cursor(cursor, kind, sort, order)
+        if order == 'desc':
+            # keys are descending: skip everything >= after
+            lo, hi = 0, len(keys)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if keys[mid] >= after:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            start = lo
+        else:
+            start = bisect.bisect_right(keys, after)
+
+    items, last_key, has_more = [], None, False
+    for i in range(start, len(entries)):
+        if not accept(entries[i]):
+            continue
+        if len(items) == limit:
+            has_more = True
+            break
+        items.append((entries[i][0], entries[i][1]))
+        last_key = keys[i]
 
+    return jsonify({
+        'kind': kind,
+        'sort': sort,
+        'order': order,
+        'items': items,
+        'has_more': has_more,
+        'next_cursor': encode_cursor((kind, sort, order) + last_key) if has_more else None,
+    })
 
+def flagged_paths():
+    """Web paths ("/RED/1-2025…/ihu01/…jpg") that carry keyboard flags."""
+    return flag_store.paths()
 
-def parse_file_date(filename):
+def commented_paths():
     """
-    Extract a date (YYYYMMDD) from the filename and return a datetime object.
-    Return None if no date is found.
+    (web paths, bare filenames) with comments. Markup comments point at
+    /hatpi/markup_images/<name>, so those count for any file of that name.
     """
-    match = re.search(r'(\d{4})(\d{2})(\d{2})', filename)
-    if match:
-        year = int(match.group(1))
-        month = int(match.group(2))
-        day = int(match.group(3))
-        return datetime.datetime(year, month, day)
-    return None
+    return comment_store.commented_paths()
+
+def annotations_version():
+    """Changes whenever the flag or comment files do."""
+    return [flag_store.signature(), comment_store.signature()]
+
+def is_date_based_folder(folder_name):
+    return re.match(r'\d{4}-\d{2}-\d{2}', folder_name) is not None
 
 def get_cached_files(folder_path: str):
     """
     Return three lists – images, html_files, movies – for *folder_path*.
     Each list contains tuples of the form (filename, creation_date_str).
+    """
+    return get_cached_listing(folder_path)[1]
+
+def get_cached_listing(folder_path: str):
+    """
+    Return (folder_mtime, (images, html_files, movies)) for *folder_path*,
+    where folder_mtime is the mtime the listing was taken at (None if the
+    folder does not exist).
 
     Key points for speed:
 
-    1.  Use os.scandir once (45–60× fewer syscalls than os.listdir + os.stat).
-    2.  Avoid os.stat entirely for typical IHU folders; parse the date that
-        already sits in every filename.
-    3.  Store a (folder_mtime, data) tuple in the cache so we only re-scan
-        when that specific directory has changed.
+    1.  Store a (folder_mtime, data, cached_at) tuple in the cache so we only
+        re-scan when that specific directory has changed.
+    2.  Look in the worker-shared cache, then the persistent file index,
+        before touching NFS; only then do one scan_folder() pass.
+    3.  Once an entry's TTL runs out, serve it stale while a background
+        thread rescans the folder.
     """
 
     start_time = time.time()
 
     # ---- 0. Quick cache hit -------------------------------------------------
+    # Changed folders are evicted via the invalidation manifest, so a fresh
+    # entry is served without touching NFS at all.
+    cached_entry, state = cache.lookup(folder_path)
+    if state == 'fresh':
+        logging.info(
+            "get_cached_files – served from cache in %.3f s",
+            time.time() - start_time,
+        )
+        return cached_entry[0], cached_entry[1]
+
     try:
         folder_mtime = os.path.getmtime(folder_path)
     except FileNotFoundError as e:
         logging.error("get_cached_files – folder does not exist: %s", folder_path)
-        return [], [], []
+        return None, ([], [], [])
+
+    if state == 'stale':
+        cached_mtime, cached_data, _ = cached_entry
+        # TTL ran out but the folder is unchanged: renew the entry
+        if cached_mtime == folder_mtime:
+            cache_listing(folder_path, folder_mtime, cached_data, time.time(), shared=False)
+            logging.info(
+                "get_cached_files – revalidated cache in %.3f s",
+                time.time() - start_time,
+            )
+            return cached_mtime, cached_data
+        # Someone is already rescanning it: don't queue up behind them
+        if scan_flights.in_flight(folder_path) or refresh_listing_in_background(folder_path, folder_mtime):
+            logging.info(
+                "get_cached_files – served stale, rescanning in background, in %.3f s",
+                time.time() - start_time,
+            )
+            return cached_mtime, cached_data
 
-    # Cache entry layout: (cached_mtime, (images, html_files, movies), cached_at_epoch)
-    cached_entry = cache.get(folder_path)
-    if cached_entry:
+    images, html_files, movies = load_folder_listing(folder_path, folder_mtime)
+    logging.info(
+        "get_cached_files – loaded %s in %.3f s – items: %d jpg, %d html, %d mp4",
+        folder_path, time.time() - start_time, len(images), len(html_files), len(movies)
+    )
+    return folder_mtime, (images, html_files, movies)
+
+class _InFlight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Collapse concurrent loads of the same key into one.
+
+    Within a worker, the first caller runs the load and the others wait on
+    its result. Across workers, the leader also holds an flock on a
+    per-key file under *lock_dir*; a leader that has to wait for that lock
+    runs its load afterwards, which is expected to find the other worker's
+    result in the shared cache. Nobody waits longer than *timeout*: past
+    that, the caller simply does the work itself.
+    """
+    def __init__(self, lock_dir, timeout=SCAN_WAIT_SECONDS):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.cross_worker_waits = 0
+        self.timeouts = 0
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlight()
+        if not leader:
+            self.followers += 1
+            if call.event.wait(self.timeout) and call.error is None:
+                return call.result
+            self.timeouts += 1
+            return fn()
+
+        self.leaders += 1
         try:
-            cached_mtime, cached_data, cached_at = cached_entry
-            # Serve if mtime unchanged
-            if cached_mtime == folder_mtime:
-                logging.info(
-                    "get_cached_files – served from cache in %.3f s",
-                    time.time() - start_time,
-                )
-                return cached_data
-            # Short TTL fallback to reduce rescans on frequently updated dirs (e.g., IHU)
-            PER_FOLDER_CACHE_TTL_SECONDS = 15
-            if (time.time() - cached_at) < PER_FOLDER_CACHE_TTL_SECONDS:
-                logging.info(
-                    "get_cached_files – served slightly stale (TTL) in %.3f s",
-                    time.time() - start_time,
-                )
-                return cached_data
-        except Exception:
-            # Ignore malformed cache entry and rebuild
-            pass
+            call.result = self._across_workers(key, fn)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _across_workers(self, key, fn):
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_path = os.path.join(self.lock_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock')
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o666)
+        except OSError as e:
+            logging.warning("SingleFlight – no lock file for %s: %s", key, e)
+            return fn()
+        try:
+            deadline = time.monotonic() + self.timeout
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not waited:
+                        waited = True
+                        self.cross_worker_waits += 1
+                    if time.monotonic() >= deadline:
+                        self.timeouts += 1
+                        return fn()
+                    time.sleep(0.05)
+            try:
+                return fn()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'cross_worker_waits': self.cross_worker_waits,
+            'timeouts': self.timeouts,
+        }
 
-    # ---- 1. Decide which filename-parsing rules apply -----------------------
-    is_ihu_folder   = "/nfs/hatops/ar0/hatpi-website/ihu-" in folder_path
-    is_date_folder  = bool(re.match(r'/nfs/hatops/ar0/hatpi-website/1-\d{8}', folder_path))
+scan_flights = SingleFlight(SCAN_LOCK_DIR)
 
-    # ---- 2. One fast scan with os.scandir -----------------------------------
-    images_tmp:  list[tuple[str, datetime.datetime, str]] = []  # (fname, dt, dt_str)
-    html_tmp:    list[tuple[str, datetime.datetime, str]] = []
-    movies_tmp:  list[tuple[str, datetime.datetime, str]] = []
+def cache_listing(folder_path, folder_mtime, data, cached_at, shared=True):
+    cache.put(folder_path, (folder_mtime, data, cached_at),
+              ttl=FOLDER_CACHE_TTL_SECONDS, stale_ttl=FOLDER_CACHE_STALE_SECONDS)
+    if shared:
+        shared_cache.put(folder_path, folder_mtime, data, cached_at)
 
-    try:
-        with os.scandir(folder_path) as it:
-            for de in it:                           # DirEntry gives stat() for free
-                if not de.is_file():
-                    continue
-                fname = de.name
-                ext   = os.path.splitext(fname)[1].lower()
+def load_folder_listing(folder_path, folder_mtime):
+    """
+    Fill the caches for *folder_path* at *folder_mtime* from the shared cache,
+    the file index or, failing both, one scan_folder() pass. Concurrent
+    loads of the same folder, in this worker or another, share one scan.
+    """
+    return scan_flights.do(folder_path, lambda: _load_folder_listing(folder_path, folder_mtime))
 
-                # 2.a. derive the timestamp -------------------------------
-                if is_ihu_folder:
-                    dt = parse_file_date(fname) or datetime.datetime.min
-                else:
-                    # stat() is cached inside the DirEntry after first access
-                    dt = datetime.datetime.fromtimestamp(de.stat().st_mtime)
-
-                dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
-
-                # 2.b. bucket by file type --------------------------------
-                if ext == '.jpg':
-                    images_tmp.append((fname, dt, dt_str))
-                elif ext == '.html':
-                    html_tmp.append((fname, dt, dt_str))
-                elif ext == '.mp4':
-                    movies_tmp.append((fname, dt, dt_str))
+def _load_folder_listing(folder_path, folder_mtime):
+    # ---- 1. Another worker may already have scanned this mtime -------------
+    shared_entry = shared_cache.get(folder_path, folder_mtime)
+    if shared_entry:
+        data = tuple(shared_entry[1])
+        cache_listing(folder_path, folder_mtime, data, shared_entry[2], shared=False)
+        return data
+
+    # ---- 2. Persistent index (survives restarts) ----------------------------
+    try:
+        indexed = file_index.listing(folder_path, folder_mtime)
+    except sqlite3.Error as e:
+        logging.warning("file index lookup failed for %s: %s", folder_path, e)
+        indexed = None
+    if indexed is not None:
+        cache_listing(folder_path, folder_mtime, indexed, time.time())
+        return indexed
+
+    # ---- 3. One fast scan with os.scandir -----------------------------------
+    try:
+        images, html_files, movies, subdirs = scan_folder(folder_path)
     except Exception as e:
         logging.error("get_cached_files – error reading %s: %s", folder_path, e)
         return [], [], []
+    try:
+        file_index.store(folder_path, folder_mtime, images, html_files, movies, subdirs)
+    except sqlite3.Error as e:
+        logging.warning("file index store failed for %s: %s", folder_path, e)
 
-    # ---- 3. Sorting ---------------------------------------------------------
-    if is_ihu_folder:
-        images_tmp.sort(key=lambda x: x[1], reverse=True)
-        html_tmp.sort(
-            key=lambda x: (0 if 'telescope_status' in x[0] else 1, x[1]),
-            reverse=True,
-        )
-        movies_tmp.sort(key=lambda x: x[1], reverse=True)
-
-    elif is_date_folder:
-        images_tmp.sort(key=lambda x: extract_ihu_number(x[0]))
-        html_tmp.sort(
-            key=lambda x: (0 if 'telescope_status' in x[0] else 1,
-                           extract_ihu_number(x[0])),
-        )
-        movies_tmp.sort(key=lambda x: extract_ihu_number(x[0]))
-
-    else:   # generic fallback – newest first
-        images_tmp.sort(key=lambda x: x[1], reverse=True)
-        html_tmp.sort(  key=lambda x: x[1], reverse=True)
-        movies_tmp.sort(key=lambda x: x[1], reverse=True)
+    # ---- 4. Cache & return --------------------------------------------------
+    cache_listing(folder_path, folder_mtime, (images, html_files, movies), time.time())
+    return images, html_files, movies
 
-    # ---- 4. Strip the extra dt object for template compatibility -----------
-    images      = [(f, s) for (f, _, s) in images_tmp]
-    html_files  = [(f, s) for (f, _, s) in html_tmp]
-    movies      = [(f, s) for (f, _, s) in movies_tmp]
+_background_refreshes = set()
+_background_refreshes_lock = threading.Lock()
 
-    # ---- 5. Cache & return --------------------------------------------------
-    cache.put(folder_path, (folder_mtime, (images, html_files, movies), time.time()))
+def refresh_listing_in_background(folder_path, folder_mtime):
+    """
+    Start a daemon thread that reloads *folder_path*. Returns False when
+    stale-while-revalidate is disabled. At most one refresh per folder runs
+    at a time in this worker.
+    """
+    if FOLDER_CACHE_STALE_SECONDS <= 0:
+        return False
+    with _background_refreshes_lock:
+        if folder_path in _background_refreshes:
+            return True
+        _background_refreshes.add(folder_path)
+
+    def run():
+        try:
+            load_folder_listing(folder_path, folder_mtime)
+        except Exception as e:
+            logging.error("Background refresh of %s failed: %s", folder_path, e)
+        finally:
+            with _background_refreshes_lock:
+                _background_refreshes.discard(folder_path)
 
-    logging.info(
-        "get_cached_files – scanned %s in %.3f s – items: %d jpg, %d html, %d mp4",
-        folder_path, time.time() - start_time, len(images), len(html_files), len(movies)
-    )
-    return images, html_files, movies
+    threading.Thread(target=run, daemon=True).start()
+    return True
 
 
 @app.route("/lcplots")
@@ -796,14 +1771,14 @@ def serve_lcplot(filepath):
         return render_template("lcplots.html", files=all_items, current_dir=filepath)
     
     # If it's a file, serve it
-    return send_file(file_path)
+    return serve_file(os.path.realpath(file_path))
 
 
 @app.route("/skyflats_runtimes")
 @app.route("/hatpi/skyflats_runtimes")
 def skyflats_runtimes():
     """Serve the Daily Skyflats & Task Runtimes page"""
-    daily_dir = "/nfs/hatops/ar0/hatpi-website/daily"
+    daily_dir = os.path.join(BASE_DIR, 'daily')
     
     skyflat_files = []
     runtime_files = []
@@ -863,24 +1838,96 @@ def skyflats_runtimes():
 @app.route('/hatpi/daily/<filename>')
 def serve_daily_file(filename):
     """Serve files from the daily directory"""
-    daily_dir = "/nfs/hatops/ar0/hatpi-website/daily"
+    daily_dir = os.path.join(BASE_DIR, 'daily')
     file_path = os.path.join(daily_dir, filename)
     
     if os.path.exists(file_path) and os.path.isfile(file_path):
-        return send_file(file_path)
+        return serve_file(os.path.realpath(file_path))
     else:
         return "File not found", 404
 
 
+def store_body_loader(store):
+    """EncodedJSON loader for a comment or flag store."""
+    def load(signature_only=False):
+        signature = store.signature()
+        return signature if signature_only else (signature, store.all())
+    return load
+
+comments_json = EncodedJSON(store_body_loader(comment_store))
+keyboard_flags_json = EncodedJSON(store_body_loader(flag_store))
+
 @app.route('/hatpi/comments.json')
 def get_comments():
-    try:
-        with open(COMMENTS_FILE, 'r') as file:
-            comments = json.load(file)
-        return jsonify(comments)
-    except Exception as e:
-        app.logger.error("Error loading comments: {}".format(str(e)))
-        return jsonify({})
+    # Version first: the data can only be newer, and replaying changes is harmless
+    version = annotations_version_token()
+    response = comments_json.response()
+    response.headers['X-Annotations-Version'] = version
+    return response
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, COMPRESS_GZIP_LEVEL, mtime=0)
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of bytes chunk by chunk, as one gzip/brotli stream."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits 16 + 15: gzip container, header mtime 0 like gzip.compress(mtime=0)
+        compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def compress_response(response):
+    """
+    gzip or brotli a JSON/HTML response when the client accepts it. Skips
+    file responses (send_file), bodies under COMPRESS_MIN_BYTES and anything
+    already encoded. Streamed responses (the full /api/folder listing) are
+    compressed as they stream. Responses with a strong ETag are compressed
+    once per (endpoint, ETag, encoding) and go out with the weak form of
+    that ETag, like nginx's gzip does.
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        # Size unknown up front, and these are the biggest bodies we send
+        encoding = preferred_encoding(('br', 'gzip') if brotli is not None else ('gzip',))
+        if encoding:
+            response.response = compress_stream(response.iter_encoded(), encoding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+            etag, weak = response.get_etag()
+            if etag:
+                response.set_etag(etag, weak=True)
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = preferred_encoding(('br', 'gzip') if brotli is not None else ('gzip',))
+    if not encoding:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (request.endpoint, etag, encoding) if etag and not weak else None
+    compressed = compressed_responses.get(key) if key else None
+    if compressed is None:
+        compressed = compress_body(body, encoding)
+        if key:
+            compressed_responses.put(key, compressed)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
 
 @app.after_request
 def after_request(response):
@@ -890,9 +1937,8 @@ def after_request(response):
     
     # Add cache control headers for static files
     if request.endpoint == 'custom_static' or request.endpoint == 'static':
-        # Check if it's a versioned file (has 'v=' parameter) 
-        query_string = request.query_string.decode()
-        if 'v=' in query_string and CACHE_VERSION in query_string:
+        # Check if it's a versioned file (its ?v= is the content hash)
+        if g.get('static_immutable'):
             # Versioned files - cache for 1 year since they'll change URL when updated
             response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
             # Remove no-cache headers if they exist
@@ -903,8 +1949,8 @@ def after_request(response):
             response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
             response.headers['Pragma'] = 'no-cache'
             response.headers['Expires'] = '0'
-    
-    return response
+
+    return compress_response(response)
 
 @app.route('/api/save_markups', methods=['POST'])
 def save_markups():
@@ -930,23 +1976,105 @@ def save_markups():
         with open(save_file_path, 'wb') as f:
             f.write(image_data)
 
-        comments = load_comments()
         unique_key = '%s_%s' % (file_name, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
-        comments[unique_key] = {
+        comment_store.add(unique_key, {
             'comment': comment,
             'author': author,
             'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'file_path': '/hatpi/markup_images/%s' % file_name,
             'markup_true': markup_true,
             'flags': flags
-        }
-        save_comments(comments)
+        })
 
         return jsonify(success=True)
     except Exception as e:
         app.logger.error("Error saving markups: {}".format(str(e)))
         return jsonify(success=False, message=str(e))
 
+def resolve_file(path):
+    """
+    (real path, size, mtime) of the regular file *path* leads to once
+    symlinks are followed, or None if there is none. Cached per path, so a
+    hit costs no NFS round-trip; see RESOLVED_PATH_* and invalidate_folders().
+    """
+    entry = resolved_paths.get(path)
+    if entry is not None:
+        return entry or None
+    real_path = os.path.realpath(path)
+    try:
+        st = os.stat(real_path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        resolved_paths.put(path, (), ttl=RESOLVED_PATH_NEGATIVE_TTL_SECONDS)
+        return None
+    entry = (real_path, st.st_size, st.st_mtime)
+    resolved_paths.put(path, entry)
+    return entry
+
+def serve_file(real_path, etag=None, last_modified=None, max_age=None, immutable=False):
+    """
+    Respond with the file at *real_path* (already validated, symlinks
+    resolved): an internal redirect for the proxy when FILE_OFFLOAD is on,
+    so no worker is held while a large movie streams, else send_file.
+    The caching arguments come from serve_product().
+    """
+    if FILE_OFFLOAD == 'off':
+        response = send_file(real_path, etag=etag if etag is not None else True,
+                             last_modified=last_modified, max_age=max_age)
+    else:
+        response = Response(mimetype=mimetypes.guess_type(real_path)[0] or 'application/octet-stream')
+        if etag is not None:
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.make_conditional(request)
+        if response.status_code == 304:
+            # The client's copy is current; nothing for the proxy to send
+            return with_cache_policy(response, max_age, immutable)
+        if FILE_OFFLOAD == 'nginx':
+            response.headers['X-Accel-Redirect'] = quote(FILE_OFFLOAD_PREFIX + real_path)
+        else:
+            response.headers['X-Sendfile'] = real_path
+    return with_cache_policy(response, max_age, immutable)
+
+def with_cache_policy(response, max_age, immutable):
+    if max_age is not None:
+        response.headers['Cache-Control'] = 'public, max-age=%d%s' % (max_age, ', immutable' if immutable else '')
+    return response
+
+def file_cache_policy(web_path, real_path):
+    """
+    (max_age, immutable) for a night's product, or None for files that
+    belong to no night. Final: RED/SUB frames, and anything of a night at
+    least FINAL_AFTER_DAYS old. Tonight's and yesterday's files: short.
+    """
+    if any(pattern.match(os.path.basename(real_path)) for pattern in FINAL_FILE_PATTERNS):
+        return IMMUTABLE_MAX_AGE, True
+    match = NIGHT_IN_PATH_RE.search(web_path) or NIGHT_IN_PATH_RE.search(real_path)
+    if not match:
+        return None
+    try:
+        night = datetime.datetime.strptime(match.group(1), '%Y%m%d').date()
+    except ValueError:
+        return None
+    if (datetime.date.today() - night).days >= FINAL_AFTER_DAYS:
+        return IMMUTABLE_MAX_AGE, True
+    return RECENT_MAX_AGE, False
+
+def serve_product(resolved):
+    """
+    serve_file() for a resolve_file() entry under the date, IHU, RED or SUB
+    folders, with file_cache_policy() applied and a strong ETag from size
+    and mtime (the format nginx uses, so offloaded or not it is the same).
+    """
+    real_path, size, mtime = resolved
+    policy = file_cache_policy(request.path, real_path)
+    if policy is None:
+        return serve_file(real_path)
+    max_age, immutable = policy
+    return serve_file(real_path, etag='%x-%x' % (int(mtime), size), last_modified=mtime,
+                      max_age=max_age, immutable=immutable)
+
 @app.route('/<folder_name>/<filename>')
 def file(folder_name, filename):
     app.logger.info(f"Catch-all route called with folder_name='{folder_name}', filename='{filename}'")
@@ -960,16 +2088,17 @@ def file(folder_name, filename):
         return custom_static(static_filename)
     
     folder_path = os.path.join(BASE_DIR, folder_name)
-    file_path = os.path.join(folder_path, filename)
+    # What send_from_directory checks: no escaping the folder, must be a file
+    file_path = safe_join(folder_path, filename)
 
     app.logger.info("Requested file: %s" % file_path)
 
-    if os.path.islink(file_path):
-        real_path = os.path.realpath(file_path)
-        app.logger.info("Resolved symlink %s to %s" % (file_path, real_path))
-        return send_file(real_path)
-
-    return send_from_directory(folder_path, filename)
+    resolved = resolve_file(file_path) if file_path else None
+    if resolved is None:
+        abort(404)
+    if resolved[0] != file_path:
+        app.logger.info("Resolved symlink %s to %s" % (file_path, resolved[0]))
+    return serve_product(resolved)
 
 @app.route('/ihu/ihu-<cell_number>')
 def ihu_cell(cell_number):
@@ -977,22 +2106,8 @@ def ihu_cell(cell_number):
     # Avoid expensive full directory scans at render time; page JS will load via /api/folder
     images, html_files, movies = [], [], []
 
-    # Load keyboard flags
-    keyboard_flags = load_keyboard_flags()
-
-    # Because your real folder or your JSON might use "ihu03"
-    alt_folder_name = folder_name.replace('ihu-', 'ihu')
-
-    flagged_for_folder = []
-    for fullpath, flag_data in keyboard_flags.items():
-        # Substring-check for both "ihu-03" and "ihu03"
-        if folder_name in fullpath or alt_folder_name in fullpath:
-            flagged_for_folder.append({
-                "file_path": fullpath,
-                "flags": flag_data.get("flags", []),
-                "timestamp": flag_data.get("timestamp", ""),
-                "author": flag_data.get("author", "")
-            })
+    # Flags under "ihu-03" folders and RED/SUB "ihu03" subfolders alike
+    flagged_for_folder = flag_store.for_folder(folder_name)
 
     return render_template(
         'folder.html',
@@ -1015,17 +2130,15 @@ def submit_comment():
     flags = data.get('flags', [])
     
     if file_name and comment:
-        comments = load_comments()
         unique_key = '%s_%s' % (file_name, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
-        comments[unique_key] = {
+        comment_store.add(unique_key, {
             'file_path': file_path,
             'comment': comment,
             'author': author,
             'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'markup_true': markup_true,
             'flags': flags
-        }
-        save_comments(comments)
+        })
         return jsonify({'success': True})
     return jsonify({'success': False})
 
@@ -1034,12 +2147,8 @@ def delete_comment():
     data = request.get_json()
     comment_id = data.get('commentId')
     
-    if comment_id:
-        comments = load_comments()
-        if comment_id in comments:
-            del comments[comment_id]
-            save_comments(comments)
-            return jsonify({'success': True})
+    if comment_id and comment_store.delete(comment_id):
+        return jsonify({'success': True})
     return jsonify({'success': False})
 
 @app.route('/RED/<path:subpath>')
@@ -1053,24 +2162,13 @@ def serve_red_path(subpath):
     # The base for RED is: /nfs/hatops/ar0/hatpi-website/RED
     red_base = os.path.join(BASE_DIR, 'RED')
     # Then we join subpath => /nfs/hatops/ar0/hatpi-website/RED/1-20250216/ihu50/1-4879...
-    target_dir = os.path.join(red_base, os.path.dirname(subpath))
-    filename = os.path.basename(subpath)
-
-    # Resolve symlinks
-    real_dir = os.path.realpath(target_dir)
-    full_file_path = os.path.join(real_dir, filename)
-
-    app.logger.info(f"Serving RED file: {full_file_path}")
-    if not os.path.isfile(full_file_path):
+    # and resolve symlinks (cached)
+    resolved = resolve_file(os.path.join(red_base, subpath))
+    if resolved is None:
         return "Not Found", 404
 
-    # Option 1: use send_file
-    from flask import send_file
-    return send_file(full_file_path)
-
-    # or Option 2: use send_from_directory if you prefer
-    # from flask import send_from_directory
-    # return send_from_directory(real_dir, filename, follow_symlinks=True)
+    app.logger.info(f"Serving RED file: {resolved[0]}")
+    return serve_product(resolved)
 
 
 @app.route('/SUB/<path:subpath>')
@@ -1082,18 +2180,12 @@ def serve_sub_path(subpath):
     import os
 
     sub_base = os.path.join(BASE_DIR, 'SUB')
-    target_dir = os.path.join(sub_base, os.path.dirname(subpath))
-    filename = os.path.basename(subpath)
-
-    real_dir = os.path.realpath(target_dir)
-    full_file_path = os.path.join(real_dir, filename)
-
-    app.logger.info(f"Serving SUB file: {full_file_path}")
-    if not os.path.isfile(full_file_path):
+    resolved = resolve_file(os.path.join(sub_base, subpath))
+    if resolved is None:
         return "Not Found", 404
 
-    from flask import send_file
-    return send_file(full_file_path)
+    app.logger.info(f"Serving SUB file: {resolved[0]}")
+    return serve_product(resolved)
 
 
 @app.route('/api/subfolders/<path:folder_name>')
@@ -1102,27 +2194,234 @@ def api_subfolders(folder_name):
     Returns a JSON list of subfolder names (not files) directly inside 'folder_name'.
     This is used by the front-end to show "date" subfolders in the IHU folder's RED or SUB directory.
     E.g. /api/subfolders/ihu-01/RED => ["1-20250213", "1-20250216", ...]
+
+    Optional query parameters:
+      from, to   keep only 1-YYYYMMDD subfolders in this date range (inclusive;
+                 YYYYMMDD or YYYY-MM-DD)
+      counts=1   also return {"counts": {name: {"files": n, "subfolders": m}}}
     """
     full_path = os.path.join(BASE_DIR, folder_name)
-    if not os.path.isdir(full_path):
-        return jsonify({"subfolders": []})
-
     try:
-        entries = os.listdir(full_path)
-    except Exception as e:
-        app.logger.error(f"Error listing subfolders in {full_path}: {e}")
+        date_from, date_to = _date_arg('from'), _date_arg('to')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Directories only (including symlinks that point to directories), served
+    # from cache or the file index unless the folder changed since then.
+    folder_mtime, subdirs = get_cached_subfolders(full_path)
+    if subdirs is None:
         return jsonify({"subfolders": []})
 
-    # We only want directories (including symlinks that point to directories).
-    subfolders = []
-    for entry in entries:
-        entry_path = os.path.join(full_path, entry)
-        if os.path.isdir(entry_path):
-            subfolders.append(entry)
+    # Sorted by name (chronological for 1-YYYYMMDD folders)
+    subfolders = [name for name, _ in subdirs]
+    if date_from or date_to:
+        subfolders = [name for name in subfolders
+                      if re.match(r'^1-\d{8}$', name)
+                      and (not date_from or name[2:] >= date_from)
+                      and (not date_to or name[2:] <= date_to)]
+
+    # Counts depend on the subfolders' own contents. They come from cached
+    # listings (no stat while those are fresh), and the ETag names the mtimes
+    # those listings were taken at, so a listing served stale while it is
+    # rescanned keeps its old ETag instead of pinning old counts under a new one.
+    counts = None
+    listing_mtimes = None
+    if request.args.get('counts'):
+        counts, listing_mtimes = {}, []
+        for name in subfolders:
+            mtimes, counts[name] = subfolder_counts(os.path.join(full_path, name))
+            listing_mtimes.append(mtimes)
+
+    etag = listing_etag(full_path, folder_mtime, listing_mtimes)
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+
+    payload = {"subfolders": subfolders}
+    if counts is not None:
+        payload["counts"] = counts
+    return with_etag(jsonify(payload), etag)
+
+def subfolder_counts(folder_path):
+    """
+    ((files mtime, subfolders mtime), counts) for *folder_path*: the number
+    of listed files (jpg/html/mp4) and of subfolders, and the folder mtimes
+    the listings they were counted from were taken at.
+    """
+    files_mtime, (images, html_files, movies) = get_cached_listing(folder_path)
+    subdirs_mtime, subdirs = get_cached_subfolders(folder_path)
+    counts = {'files': len(images) + len(html_files) + len(movies), 'subfolders': len(subdirs or [])}
+    return (files_mtime, subdirs_mtime), counts
+
+class CacheWarmer:
+    """
+    Pre-scans the folders people open first – BASE_DIR, the newest date
+    folders, every ihu-XX folder, the RED/SUB night lists and the IHU lists
+    of the newest nights – on a bounded thread pool in the background, so
+    the worker serves traffic meanwhile.
+
+    Only one worker per host warms at a time (flock on *lock_path*); the
+    others get the results through the shared cache.
+    """
+    def __init__(self, lock_path, threads=WARMUP_THREADS, recent_dates=WARMUP_RECENT_DATES):
+        self.lock_path = lock_path
+        self.threads = threads
+        self.recent_dates = recent_dates
+        self._lock = threading.Lock()
+        self._state = {'status': 'idle'}
+
+    def start(self, reason):
+        """Start warming in a daemon thread; returns False if already running here."""
+        with self._lock:
+            if self._state.get('status') == 'running':
+                return False
+            self._state = {'status': 'running', 'reason': reason, 'started_at': time.time(),
+                           'total': 0, 'done': 0, 'failed': 0}
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def status(self):
+        state = dict(self._state)
+        if state.get('status') == 'running':
+            state['elapsed'] = round(time.time() - state['started_at'], 3)
+        return state
+
+    def _finish(self, status, **extra):
+        with self._lock:
+            self._state.update(status=status, finished_at=time.time(),
+                               seconds=round(time.time() - self._state['started_at'], 3), **extra)
+
+    def _targets(self):
+        """(kind, path) pairs; kind is 'files' for folder listings, 'dirs' for subfolder lists."""
+        targets = []
+        names = [name for name, _ in get_cached_subfolders(BASE_DIR)[1] or []]
+        dates = sorted((n for n in names if re.match(r'^1-\d{8}$', n)), reverse=True)
+        targets += [('files', os.path.join(BASE_DIR, n)) for n in dates[:self.recent_dates]]
+        targets += [('files', os.path.join(BASE_DIR, n)) for n in sorted(names) if n.startswith('ihu-')]
+        for product in ('RED', 'SUB'):
+            product_dir = os.path.join(BASE_DIR, product)
+            nights = sorted((n for n, _ in get_cached_subfolders(product_dir)[1] or []), reverse=True)
+            targets += [('dirs', os.path.join(product_dir, n)) for n in nights[:self.recent_dates]]
+        return targets
+
+    def _warm(self, kind, path):
+        if kind == 'files':
+            get_cached_files(path)
+        else:
+            get_cached_subfolders(path)
+
+    def _run(self):
+        try:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            lock_file = open(self.lock_path, 'a')
+        except OSError as e:
+            logging.error("Cache warm-up: cannot open %s: %s", self.lock_path, e)
+            self._finish('failed', error=str(e))
+            return
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Cache warm-up skipped: another worker is warming")
+                self._finish('skipped')
+                return
+            get_cached_dir_list(BASE_DIR)
+            targets = self._targets()
+            self._state['total'] = len(targets)
+            logging.info("Cache warm-up (%s): %d folders on %d threads",
+                         self._state['reason'], len(targets), self.threads)
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                futures = {pool.submit(self._warm, kind, path): path for kind, path in targets}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                        self._state['done'] += 1
+                    except Exception as e:
+                        self._state['failed'] += 1
+                        logging.error("Cache warm-up of %s failed: %s", futures[future], e)
+                    finished = self._state['done'] + self._state['failed']
+                    if finished % 10 == 0 or finished == len(targets):
+                        logging.info("Cache warm-up: %d/%d folders in %.1f s", finished, len(targets),
+                                     time.time() - self._state['started_at'])
+            self._finish('done')
+            logging.info("Cache warm-up finished in %.1f s", self._state['seconds'])
+        except Exception as e:
+            logging.error("Cache warm-up failed: %s", e)
+            self._finish('failed', error=str(e))
+        finally:
+            lock_file.close()
+
+cache_warmer = CacheWarmer(os.path.join(LOCAL_CACHE_DIR, 'warmup.lock'))
 
-    # Sort them (reverse=False so you get chronological, if you prefer)
-    subfolders.sort()
-    return jsonify({"subfolders": subfolders})
+def start_cache_warmup(reason='startup'):
+    return cache_warmer.start(reason)
+
+def warmup_token():
+    """The secret in WARMUP_TOKEN_FILE, creating it (once, race-free) if missing."""
+    try:
+        with open(WARMUP_TOKEN_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    tmp_path = '%s.%d.tmp' % (WARMUP_TOKEN_FILE, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32) + '\n')
+        try:
+            # Another worker may have won the race; its token stands
+            os.link(tmp_path, WARMUP_TOKEN_FILE)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    with open(WARMUP_TOKEN_FILE) as f:
+        return f.read().strip()
+
+@app.route('/api/warmup', methods=['GET', 'POST'])
+def api_warmup():
+    """
+    GET: this worker's warm-up progress. POST: start a warm-up; only accepted
+    straight from the host itself, not through a proxy, with the secret from
+    WARMUP_TOKEN_FILE (run_all.sh calls it after an ingest). A warm-up
+    already running in this worker is left alone.
+    """
+    if request.method == 'POST':
+        if (request.remote_addr not in ('127.0.0.1', '::1')
+                or any(header in request.headers for header in PROXY_HEADERS)):
+            return jsonify(success=False, message="warm-up can only be triggered locally"), 403
+        try:
+            token = warmup_token()
+        except OSError as e:
+            app.logger.error(f"Cannot read {WARMUP_TOKEN_FILE}: {e}")
+            return jsonify(success=False, message="warm-up token unavailable"), 500
+        if not hmac.compare_digest(request.headers.get('X-Warmup-Token', ''), token):
+            return jsonify(success=False, message="missing or wrong X-Warmup-Token"), 403
+        started = start_cache_warmup('ingest')
+        return jsonify(success=True, started=started, status=cache_warmer.status())
+    return jsonify(cache_warmer.status())
+
+@app.route('/api/cache_stats')
+def api_cache_stats():
+    """
+    Per-worker cache counters. Each gunicorn worker answers for itself,
+    so repeated requests may land on different PIDs.
+    """
+    return jsonify({
+        'pid': os.getpid(),
+        'local': cache.stats(),
+        'resolved_paths': resolved_paths.stats(),
+        'compressed_responses': compressed_responses.stats(),
+        'shared': shared_cache.stats(),
+        'invalidation': invalidation_watcher.stats(),
+        'scans': scan_flights.stats(),
+        'warmup': cache_warmer.status(),
+        'annotations': {
+            'backend': STORAGE_BACKEND,
+            'comments': comment_store.stats(),
+            'flags': flag_store.stats(),
+        },
+    })
 
 @app.route('/api/keyboard_flags', methods=['POST'])
 def update_keyboard_flags():
@@ -1135,83 +2434,321 @@ def update_keyboard_flags():
     file_path = data.get('filePath')       # e.g. "/SUB/1-20250216/ihu50/1-4879..."
     new_flags = data.get('flags', [])       # List of flags
     author = "Adriana"                      # hardcoded for now
+    if not file_path:
+        return jsonify(success=False, message="filePath is required"), 400
 
-    # Load the current dictionary of keyboard flags
-    kflags = load_keyboard_flags()
-    
     # Remove duplicates and sort new flags
     final_flags = sorted(list(set(new_flags)))
-    
-    if final_flags:
-        # If there are flags, update (or add) the entry for this file path
-        kflags[file_path] = {
-            "flags": final_flags,
-            "timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            "author": author
-        }
-    else:
-        # If the flags array is empty, remove the entry if it exists
-        if file_path in kflags:
-            del kflags[file_path]
 
-    # Save the updated dictionary back to the JSON file
-    save_keyboard_flags(kflags)
+    # Adds/updates the entry, or removes it when the flags array is empty
+    try:
+        flag_store.set_flags(file_path, final_flags,
+                             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                             author)
+    except Exception as e:
+        app.logger.error(f"Error saving {KEYBOARD_FLAGS_FILE}: {e}")
+        return jsonify(success=False, message=str(e)), 500
 
     return jsonify(success=True, flags=final_flags)
 
 
-@app.route('/hatpi/keyboard_flags.json')
-def serve_kb_flags():
-    data = load_keyboard_flags()
-    return jsonify(data)
+def flag_key(path):
+    """Keyboard-flag key for a web path, with or without the /hatpi prefix."""
+    path = '/' + (path or '').lstrip('/')
+    if path.startswith('/hatpi/'):
+        path = path[len('/hatpi'):]
+    return path
 
+@app.route('/api/keyboard_flags/<path:file_path>', methods=['GET'])
+def get_keyboard_flags(file_path):
+    """Flags for one file; flags is [] when it has none."""
+    key = flag_key(file_path)
+    return jsonify(flag_view(key, flag_store.get(key) or {}))
 
+@app.route('/api/keyboard_flags/lookup', methods=['POST'])
+def lookup_keyboard_flags():
+    """
+    Body {"paths": [...]}; returns {"flags": {path: {flags, timestamp,
+    author}}} for the paths that have flags (keys normalized like the
+    keyboard_flags.json keys).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(success=False, message="body must be a JSON object"), 400
+    paths = data.get('paths')
+    if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+        return jsonify(success=False, message="paths must be a list of strings"), 400
+    if len(paths) > FLAG_LOOKUP_MAX_PATHS:
+        return jsonify(success=False, message="at most %d paths per lookup" % FLAG_LOOKUP_MAX_PATHS), 400
+    return jsonify(success=True, flags=flag_store.lookup(map(flag_key, paths)))
+
+RED_SUB_FOLDER_RE = re.compile(r'^(?:RED|SUB)/1-\d{8}(?:/ihu-?\d+)?$')
+
+def frame_range_paths(folder, frame_from, frame_to):
+    """
+    Web paths of the images in a RED/SUB night ("RED/1-20250216", every
+    ihuNN folder) or one camera ("RED/1-20250216/ihu50") whose frame number
+    is within [frame_from, frame_to]. Uses the cached listings.
+    """
+    folder = folder.strip('/')
+    if not RED_SUB_FOLDER_RE.match(folder):
+        raise ValueError("range.folder must look like RED/1-YYYYMMDD[/ihuNN]")
+    folder_path = os.path.join(BASE_DIR, folder)
+    if folder.count('/') == 2:
+        folders = [folder]
+    else:
+        _, subdirs = get_cached_subfolders(folder_path)
+        folders = ['%s/%s' % (folder, name) for name, _ in subdirs or ()]
+    paths = []
+    for sub in folders:
+        sub_path = os.path.join(BASE_DIR, sub)
+        if not os.path.isdir(sub_path):
+            continue
+        mtime, listing = get_cached_listing(sub_path)
+        for name, _, meta in get_folder_entries(sub_path, mtime, listing).by_kind['images']:
+            if meta['frame'] is not None and frame_from <= meta['frame'] <= frame_to:
+                paths.append('/%s/%s' % (sub, name))
+    return paths
+
+def parse_flag_operation(operation):
+    """[(web_path, op, flags)] for one operation of a batch request."""
+    if not isinstance(operation, dict):
+        raise ValueError("each operation must be an object")
+    op, flags = operation.get('op'), operation.get('flags', [])
+    if op not in FLAG_OPS:
+        raise ValueError("op must be one of %s" % ', '.join(FLAG_OPS))
+    if not isinstance(flags, list) or not all(isinstance(f, str) for f in flags):
+        raise ValueError("flags must be a list of strings")
+    if 'range' in operation:
+        spec = operation['range']
+        try:
+            paths = frame_range_paths(spec['folder'], int(spec['frame_from']), int(spec['frame_to']))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("bad range (%s)" % e)
+    else:
+        paths = operation.get('paths')
+        if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+            raise ValueError("paths must be a list of strings")
+        paths = [flag_key(p) for p in paths]
+    return [(path, op, flags) for path in paths]
+
+@app.route('/api/keyboard_flags/batch', methods=['POST'])
+def batch_keyboard_flags():
+    """
+    Apply flag changes to many files with one write. Body:
+      {"operations": [{"op": "add" | "remove" | "set", "flags": [...],
+                       "paths": [...]  or
+                       "range": {"folder": "RED/1-20250216[/ihu50]",
+                                 "frame_from": 487919, "frame_to": 487950}}]}
+    A single operation may also be sent as the body itself. Operations
+    apply in order. Returns the resulting flags of every affected path.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(success=False, message="body must be a JSON object"), 400
+    operations = data.get('operations', [data])
+    if not isinstance(operations, list) or not operations:
+        return jsonify(success=False, message="operations must be a non-empty list"), 400
+    try:
+        changes = [change for operation in operations for change in parse_flag_operation(operation)]
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    if len(changes) > FLAG_BATCH_MAX_PATHS:
+        return jsonify(success=False, message="at most %d paths per batch" % FLAG_BATCH_MAX_PATHS), 400
 
-def get_creation_date(file_path):
-    return datetime.datetime.fromtimestamp(os.path.getctime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
+    author = "Adriana"  # same as update_keyboard_flags, for now
+    try:
+        result = flag_store.update_many(changes, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), author)
+    except Exception as e:
+        app.logger.error(f"Error saving keyboard flags batch: {e}")
+        return jsonify(success=False, message=str(e)), 500
+    return jsonify(success=True, flags=result)
 
-def load_comments():
-    if os.path.exists(COMMENTS_FILE):
+@app.route('/hatpi/keyboard_flags.json')
+def serve_kb_flags():
+    version = annotations_version_token()
+    response = keyboard_flags_json.response()
+    response.headers['X-Annotations-Version'] = version
+    return response
+
+def comments_page(total, page, limit):
+    """
+    The /api/comments body (and a home page card) for one page of (key,
+    comment). Query limit + 1 rows: the extra one only says there is more.
+    """
+    has_more = len(page) > limit
+    page = page[:limit]
+    items = []
+    for key, comment in page:
+        item = comment_view(key, comment)
         try:
-            with open(COMMENTS_FILE, 'r') as file:
-                comments = json.load(file)
-            sorted_comments = OrderedDict(
-                sorted(comments.items(), key=lambda item: datetime.datetime.strptime(item[1]['timestamp'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-            )
-            logging.info("Comments loaded and sorted: %s" % sorted_comments)
-            return sorted_comments
-        except ValueError as e:
-            logging.error("Error loading JSON: %s" % e)
-            return {}
-    logging.info("No comments file found, returning empty dictionary")
-    return {}
+            item['display_name'] = format_filename(item['file_path'] or '')
+        except IndexError:
+            item['display_name'] = os.path.basename(item['file_path'] or '')
+        items.append(item)
+    return {
+        'items': items,
+        'total': total,
+        'has_more': has_more,
+        'next_cursor': encode_cursor(comment_sort_key(page[-1])) if has_more else None,
+    }
+
+@app.route('/api/comments')
+def api_comments():
+    """
+    One page of comments, newest first.
 
-def save_comments(comments):
-    with open(COMMENTS_FILE, 'w') as file:
-        json.dump(comments, file, indent=4)
-        
-def load_keyboard_flags():
-    if os.path.exists(KEYBOARD_FLAGS_FILE):
+      ?author=  ?folder=RED/1-20250216  ?ihu=50   filters, all optional
+      ?from=2025-02-16  ?to=2025-02-20            timestamp range, inclusive
+      ?cursor=   next_cursor of the previous page
+      ?limit=    page size (default 20, at most 200)
+    """
+    args = request.args
+    try:
+        limit = min(int(args.get('limit', COMMENTS_PAGE_DEFAULT)), COMMENTS_PAGE_MAX)
+        ihu = int(args['ihu']) if args.get('ihu') else None
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify(success=False, message="limit and ihu must be positive integers"), 400
+    before = None
+    if args.get('cursor'):
         try:
-            with open(KEYBOARD_FLAGS_FILE, 'r') as f:
-                data = json.load(f)
-            return data
-        except Exception as e:
-            app.logger.error(f"Error loading {KEYBOARD_FLAGS_FILE}: {e}")
-            return {}
-    return {}
+            before = decode_cursor(args['cursor'])
+            if len(before) != 2:
+                raise ValueError("invalid cursor")
+            before = tuple(str(v) for v in before)
+        except ValueError as e:
+            return jsonify(success=False, message=str(e)), 400
+
+    folder = args.get('folder', '').strip('/') or None
+    if folder and folder.startswith('hatpi/'):
+        folder = folder[len('hatpi/'):]
+    total, page = comment_store.query(author=args.get('author') or None, folder=folder, ihu=ihu,
+                                      start=args.get('from') or None, end=args.get('to') or None,
+                                      before=before, limit=limit + 1)
+    body = comments_page(total, page, limit)
+    body['success'] = True
+    return jsonify(body)
+
+def annotations_version_token():
+    """'<comments version>.<flags version>', the ?since= of /api/changes."""
+    return '%d.%d' % (comment_store.current_version(), flag_store.current_version())
+
+def night_arg(name):
+    """?from=/?to= as a '1-YYYYMMDD' night; accepts that, YYYYMMDD or YYYY-MM-DD."""
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    digits = raw[2:] if raw.startswith('1-') else raw.replace('-', '')
+    if not re.fullmatch(r'\d{8}', digits):
+        raise ValueError("%s must be a night like 1-20250216 or 2025-02-16" % name)
+    return '1-' + digits
+
+@app.route('/api/aggregates')
+def api_aggregates():
+    """
+    Nightly QA numbers from counters the stores keep up to date on every
+    write, so this never reads the flag or comment data itself.
+
+      ?from=  ?to=     nights to include (1-YYYYMMDD, YYYYMMDD or YYYY-MM-DD);
+                       without them files with no night count too
+      ?flag=Trail      only this flag
+      ?ihu=50          only this IHU
 
-def save_keyboard_flags(data):
+    flags.matrix is flag → night → IHU → flagged files; flags.totals is
+    flag → files. comments.by_author is author → comments, and
+    comments.by_night night → author → comments on that night's files.
+    """
+    try:
+        start, end = night_arg('from'), night_arg('to')
+        ihu = int(request.args['ihu']) if request.args.get('ihu') else None
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    only_flag = request.args.get('flag') or None
+
+    version = annotations_version_token()
+    matrix, totals, nights, ihus = {}, {}, set(), set()
+    for night, flag_ihu, flag, files in flag_store.flag_counts(start, end):
+        if (only_flag and flag != only_flag) or (ihu is not None and flag_ihu != ihu):
+            continue
+        totals[flag] = totals.get(flag, 0) + files
+        if night is None or flag_ihu is None:
+            continue
+        cells = matrix.setdefault(flag, {}).setdefault(night, {})
+        cells[flag_ihu] = cells.get(flag_ihu, 0) + files
+        nights.add(night)
+        ihus.add(flag_ihu)
+
+    by_author, by_night = {}, {}
+    for author, night, comments in comment_store.comment_counts(start, end):
+        by_author[author] = by_author.get(author, 0) + comments
+        if night is not None:
+            by_night.setdefault(night, {})[author] = comments
+
+    return jsonify(success=True, version=version,
+                   flags={'matrix': matrix, 'totals': totals,
+                          'nights': sorted(nights), 'ihus': sorted(ihus)},
+                   comments={'by_author': by_author, 'by_night': by_night})
+
+@app.route('/api/aggregates/rebuild', methods=['POST'])
+def rebuild_aggregates():
+    """Recount the aggregate counters from scratch (after hand edits to the data)."""
+    started = time.time()
     try:
-        with open(KEYBOARD_FLAGS_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
+        flag_store.rebuild_counts()
+        comment_store.rebuild_counts()
     except Exception as e:
-        app.logger.error(f"Error saving {KEYBOARD_FLAGS_FILE}: {e}")
+        app.logger.error(f"Error rebuilding aggregates: {e}")
+        return jsonify(success=False, message=str(e)), 500
+    elapsed = time.time() - started
+    logging.info("Rebuilt annotation aggregates in %.3f seconds" % elapsed)
+    return jsonify(success=True, seconds=round(elapsed, 3))
+
+@app.route('/api/changes')
+def api_changes():
+    """
+    What changed in comments and keyboard flags since a version token.
+
+      ?since=<token>   from a previous response's "version", or the
+                       X-Annotations-Version header of comments.json /
+                       keyboard_flags.json
+      ?store=comments|flags   only answer for one of them
+
+    Per store: {"changed": {key: entry}, "deleted": [keys], "reset": bool}.
+    reset means the history doesn't reach back that far; "changed" then
+    holds every entry and the client should replace its copy.
+    """
+    since = request.args.get('since', '')
+    try:
+        parts = [int(v) for v in since.split('.')]
+        if len(parts) not in (1, 2) or min(parts) < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify(success=False, message="since must be a version token like 12.40"), 400
+    comments_since, flags_since = parts if len(parts) == 2 else parts * 2
+    wanted = request.args.get('store')
+    if wanted not in (None, 'comments', 'flags'):
+        return jsonify(success=False, message="store must be comments or flags"), 400
+
+    body = {'success': True}
+    if wanted in (None, 'comments'):
+        body['comments'] = comment_store.changes_since(comments_since)
+    if wanted in (None, 'flags'):
+        body['flags'] = flag_store.changes_since(flags_since)
+    body['version'] = '%d.%d' % (body['comments']['version'] if 'comments' in body else comments_since,
+                                 body['flags']['version'] if 'flags' in body else flags_since)
+    return jsonify(body)
+
+
+
+def get_creation_date(file_path):
+    return datetime.datetime.fromtimestamp(os.path.getctime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
+
 
 
 if __name__ == '__main__':
-    polling_thread = threading.Thread(target=poll_directory)
-    polling_thread.daemon = True
-    polling_thread.start()
-    
+    # Nothing in front of the development server to follow internal redirects
+    FILE_OFFLOAD = 'off'
+    start_cache_warmup()
     app.run(debug=True, port=8080)
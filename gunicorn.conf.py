@@ -26,3 +26,10 @@ pidfile = "/nfs/hatops/ar0/hatpi-website/gunicorn.pid"
 wsgi_app = "app:app"
 
 
+def post_worker_init(worker):
+    # Pre-scan the popular folders in the background; traffic is served meanwhile.
+    # Only one worker actually warms, the rest read its results from the shared cache.
+    import app
+    app.start_cache_warmup()
+
+
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Compare file serving with and without HATPI_FILE_OFFLOAD under concurrent
+large-file load.
+
+Point it at the same movie through two deployments, e.g. gunicorn directly
+(send_file in the worker) and nginx in front with HATPI_FILE_OFFLOAD=nginx:
+
+    scripts/bench_file_offload.py \
+        worker=http://127.0.0.1:5004/SUB/1-20250216/ihu50/1-20250216_50_subframe_movie.mp4 \
+        offload=http://localhost/hatpi/SUB/1-20250216/ihu50/1-20250216_50_subframe_movie.mp4 \
+        --clients 16 --duration 30
+
+While the downloads run, a probe thread times a small API request against
+the same host. With send_file every worker ends up streaming and the probe
+latency climbs towards the gunicorn timeout; with offload it should stay flat.
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CHUNK = 256 * 1024
+
+
+def download(url, timeout):
+    """Fetch url to nowhere; returns (bytes, seconds)."""
+    started = time.monotonic()
+    total = 0
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        while True:
+            chunk = response.read(CHUNK)
+            if not chunk:
+                break
+            total += len(chunk)
+    return total, time.monotonic() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(label, url, probe_url, clients, duration, timeout):
+    deadline = time.monotonic() + duration
+    lock = threading.Lock()
+    downloads, probes, errors = [], [], []
+
+    def client():
+        while time.monotonic() < deadline:
+            try:
+                result = download(url, timeout)
+            except (urllib.error.URLError, OSError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                downloads.append(result)
+
+    def probe():
+        while time.monotonic() < deadline:
+            try:
+                _, seconds = download(probe_url, timeout)
+            except (urllib.error.URLError, OSError) as e:
+                with lock:
+                    errors.append('probe: %s' % e)
+                continue
+            with lock:
+                probes.append(seconds)
+            time.sleep(0.5)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    threads.append(threading.Thread(target=probe))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    megabytes = sum(size for size, _ in downloads) / (1024 * 1024)
+    seconds = [s for _, s in downloads]
+    return {
+        'label': label,
+        'downloads': len(downloads),
+        'errors': len(errors),
+        'MB/s': megabytes / elapsed if elapsed else 0,
+        'download p50 s': statistics.median(seconds) if seconds else float('nan'),
+        'download p95 s': percentile(seconds, 0.95),
+        'probe p50 ms': (statistics.median(probes) if probes else float('nan')) * 1000,
+        'probe max ms': (max(probes) if probes else float('nan')) * 1000,
+    }, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('targets', nargs='+', metavar='LABEL=URL',
+                        help='large file to download, one per serving mode')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent downloads (default 8)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per target (default 20)')
+    parser.add_argument('--timeout', type=float, default=150, help='per request timeout in seconds')
+    parser.add_argument('--probe-path', default='/api/cache_stats',
+                        help='small request timed alongside the downloads'
+                             ' (under /hatpi too when the target URL is)')
+    args = parser.parse_args()
+
+    rows = []
+    for target in args.targets:
+        label, _, url = target.partition('=')
+        if not url:
+            label, url = target, target
+        parts = urllib.parse.urlsplit(url)
+        probe_path = ('/hatpi' if parts.path.startswith('/hatpi/') else '') + args.probe_path
+        probe_url = urllib.parse.urlunsplit((parts.scheme, parts.netloc, probe_path, '', ''))
+        print("%s: %d clients for %ds on %s" % (label, args.clients, args.duration, url))
+        row, errors = run(label, url, probe_url, args.clients, args.duration, args.timeout)
+        for error in sorted(set(errors))[:5]:
+            print("  error: %s" % error)
+        rows.append(row)
+
+    columns = list(rows[0])
+    print()
+    print('  '.join('%14s' % c for c in columns))
+    for row in rows:
+        print('  '.join('%14s' % (('%.2f' % v) if isinstance(v, float) else v) for v in row.values()))
+
+
+if __name__ == "__main__":
+    main()
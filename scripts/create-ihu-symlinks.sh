@@ -80,6 +80,7 @@
 
 base_dir="/nfs/hatops/ar0/hatpi-website"
 LOG_FILE="/nfs/hatops/ar0/hatpi-website/logs/create_ihu_symlinks.log"
+MARK_CHANGED="/nfs/hatops/ar0/hatpi-website/scripts/mark_changed.sh"
 
 mkdir -p "$(dirname "$LOG_FILE")"
 
@@ -101,6 +102,9 @@ is_within_10_days() {
     [ $diff_days -ge 0 ] && [ $diff_days -le 10 ]
 }
 
+# ihu-XX folders that received new links, reported to the web workers at the end
+declare -A changed_dirs
+
 # Loop through each "1-" directory in the base directory
 for dir in "$base_dir"/1-*; do
   if [[ -d "$dir" ]]; then
@@ -134,6 +138,7 @@ for dir in "$base_dir"/1-*; do
               ln -s "$file" "$dest_file"
               if [ $? -eq 0 ]; then
                 log_message "Created symlink: $dest_file -> $file"
+                changed_dirs["$ihu_dir"]=1
               else
                 log_message "ERROR: Failed to create symlink: $dest_file -> $file"
               fi
@@ -155,4 +160,9 @@ for dir in "$base_dir"/1-*; do
   fi
 done
 
+if [ ${#changed_dirs[@]} -gt 0 ]; then
+  "$MARK_CHANGED" "${!changed_dirs[@]}"
+  log_message "Marked ${#changed_dirs[@]} changed ihu folders."
+fi
+
 log_message "Script completed successfully (symlink version)."
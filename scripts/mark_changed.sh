@@ -0,0 +1,55 @@
+#!/bin/bash
+# Record folders whose contents changed so the web workers evict just those
+# listings instead of waiting for their cache TTL (see InvalidationWatcher in
+# app.py). Anything that adds files under the website tree should call this.
+#
+# Usage: mark_changed.sh DIR [DIR ...]     ("*" invalidates everything)
+#
+# The web workers and the ingest user share the cache directory through
+# HATPI_SHARED_GROUP (see SHARED_GROUP in app.py): it is setgid 2775 and every
+# file in it is group-writable, whichever side created it.
+
+CACHE_DIR="${HATPI_CACHE_DIR:-/tmp/hatpi-website-cache}"
+SHARED_GROUP="${HATPI_SHARED_GROUP:-hatuser}"
+MANIFEST="$CACHE_DIR/changed_folders.log"
+MAX_BYTES=1048576
+
+umask 002
+if [ ! -d "$CACHE_DIR" ]; then
+    install -d -m 2775 -g "$SHARED_GROUP" "$CACHE_DIR" || mkdir -p "$CACHE_DIR"
+fi
+
+# Only the owner may change a file's group and mode
+share() {
+    for f in "$@"; do
+        if [ -O "$f" ]; then
+            chgrp "$SHARED_GROUP" "$f" 2>/dev/null
+            chmod 664 "$f" 2>/dev/null
+        fi
+    done
+}
+
+(
+  flock -x 9 || exit 1
+  # Rotate once the manifest gets large; workers notice the new inode and
+  # drop their whole cache once.
+  if [ -f "$MANIFEST" ] && [ "$(stat -c %s "$MANIFEST")" -gt "$MAX_BYTES" ]; then
+      mv -f "$MANIFEST" "$MANIFEST.1" || exit 1
+  fi
+  now=$(date +%s)
+  for dir in "$@"; do
+      if [ "$dir" != "/" ]; then
+          dir="${dir%/}"
+      fi
+      echo "$now $dir" >> "$MANIFEST" || exit 1
+  done
+  share "$MANIFEST" "$MANIFEST.lock"
+) 9>>"$MANIFEST.lock"
+status=$?
+
+if [ $status -ne 0 ]; then
+    echo "mark_changed.sh: could not record changed folders in $MANIFEST;" \
+         "web workers keep serving their cached listings until the TTL runs out" \
+         "(check that $(whoami) is in group $SHARED_GROUP and the file is group-writable)" >&2
+    exit $status
+fi
@@ -59,6 +59,11 @@
 SOURCE_DIR="/nfs/php2/ar0/P/HP1/REDUCTION/MOVIES"
 TARGET_DIR="/nfs/hatops/ar0/hatpi-website"
 LOG_FILE="/nfs/hatops/ar0/hatpi-website/logs/movies_to_dates.log"
+MARK_CHANGED="/nfs/hatops/ar0/hatpi-website/scripts/mark_changed.sh"
+
+# Folders that received new links (the find|while loop runs in a subshell,
+# so collect them in a file rather than a variable)
+CHANGED_LIST=$(mktemp)
 
 mkdir -p "$(dirname "$LOG_FILE")"
 
@@ -104,6 +109,7 @@ for folder in "$SOURCE_DIR"/*; do
                         ln -s "$relative_path" "$target_symlink"
                         if [ $? -eq 0 ]; then
                             log_message "Created symlink for $relative_path in $TARGET_DIR/$folder_name"
+                            echo "$TARGET_DIR/$folder_name" >> "$CHANGED_LIST"
                         else
                             log_message "ERROR: Failed to create symlink for $relative_path in $TARGET_DIR/$folder_name"
                         fi
@@ -123,4 +129,8 @@ for folder in "$SOURCE_DIR"/*; do
     fi
 done
 
+# Tell the web workers to re-list the folders that got new movies
+sort -u "$CHANGED_LIST" | xargs -r "$MARK_CHANGED"
+rm -f "$CHANGED_LIST"
+
 log_message "Script completed."
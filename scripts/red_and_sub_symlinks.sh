@@ -17,6 +17,8 @@ SUB_SOURCE="/nfs/php2/ar0/P/HP1/REDUCTION/JPEGS/SUB"
 RED_DEST="/nfs/hatops/ar0/hatpi-website/RED"
 SUB_DEST="/nfs/hatops/ar0/hatpi-website/SUB"
 
+MARK_CHANGED="/nfs/hatops/ar0/hatpi-website/scripts/mark_changed.sh"
+
 # Ensure destination directories exist
 mkdir -p "$RED_DEST"
 mkdir -p "$SUB_DEST"
@@ -47,4 +49,7 @@ done
 echo "Finished processing SUB directories. Total processed: $count"
 echo ""
 
+# Tell the web workers to re-list the RED/SUB night folders
+"$MARK_CHANGED" "$RED_DEST" "$SUB_DEST"
+
 echo "All symlinks created successfully."
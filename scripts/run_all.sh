@@ -2,6 +2,18 @@
 
 log_file="/nfs/hatops/ar0/hatpi-website/logs/run_all.log"
 
+# The web workers write the same local cache (file index, invalidation
+# manifest, locks): keep it setgid and group-writable for the shared group,
+# whichever side creates it first (see SHARED_GROUP in app.py).
+umask 002
+cache_dir="${HATPI_CACHE_DIR:-/tmp/hatpi-website-cache}"
+if [ ! -d "$cache_dir" ]; then
+  install -d -m 2775 -g "${HATPI_SHARED_GROUP:-hatuser}" "$cache_dir" >> $log_file 2>&1 || mkdir -p "$cache_dir"
+fi
+
+# Folders modified after this stamp are reported to the web workers at the end
+run_stamp=$(mktemp)
+
 echo "started at $(date)" >> $log_file
 echo "Current user: $(whoami)" >> $log_file
 echo "Current groups: $(groups)" >> $log_file
@@ -55,7 +67,30 @@ if [ $? -ne 0 ]; then
 fi
 echo "create-ihu-symlinks.sh completed at $(date)" >> $log_file
 
-# Step 6: Restart Flask application
+# Step 6: Refresh the file index (rescans only folders whose mtime changed).
+# Not fatal: the web workers check every index entry against the folder's
+# mtime, so a stale index only costs them a rescan.
+echo "Starting file index refresh at $(date)" >> $log_file
+/usr/bin/python3 /nfs/hatops/ar0/hatpi-website/file_index.py refresh >> $log_file 2>&1
+if [ $? -ne 0 ]; then
+  echo "file index refresh failed at $(date); continuing" >> $log_file
+else
+  echo "file index refresh completed at $(date)" >> $log_file
+fi
+
+# Step 7: Tell the web workers which top-level folders changed during this run
+find -L /nfs/hatops/ar0/hatpi-website /nfs/hatops/ar0/hatpi-website/RED /nfs/hatops/ar0/hatpi-website/SUB \
+  -maxdepth 1 -type d -newer "$run_stamp" -print0 2>/dev/null \
+  | xargs -0 -r /bin/bash /nfs/hatops/ar0/hatpi-website/scripts/mark_changed.sh >> $log_file 2>&1
+if [ $? -ne 0 ]; then
+  echo "MARKING CHANGED FOLDERS FAILED at $(date): web workers serve old listings until their TTL" >> $log_file
+  echo "run_all.sh: mark_changed.sh failed, see $log_file" >&2
+else
+  echo "changed folders marked at $(date)" >> $log_file
+fi
+rm -f "$run_stamp"
+
+# Step 8: Restart Flask application
 echo "Starting restart_flask.sh at $(date)" >> $log_file
 /bin/bash /nfs/hatops/ar0/hatpi-website/scripts/restart_flask.sh >> $log_file 2>&1
 if [ $? -ne 0 ]; then
@@ -64,4 +99,17 @@ if [ $? -ne 0 ]; then
 fi
 echo "restart_flask.sh completed at $(date)" >> $log_file
 
+# Step 9: Re-warm the listing caches (a running gunicorn is not restarted)
+echo "Requesting cache warm-up at $(date)" >> $log_file
+warmup_token=$(cat "$cache_dir/warmup.token" 2>/dev/null)
+curl -s -X POST -H "X-Warmup-Token: $warmup_token" http://127.0.0.1:5004/api/warmup >> $log_file 2>&1 \
+  || echo "cache warm-up request failed" >> $log_file
+echo >> $log_file
+
+# Step 10: Fold the flag/comment journals back into the JSON files. The
+# rewritten files stay group-writable for the web workers (make_group_writable)
+/usr/bin/python3 /nfs/hatops/ar0/hatpi-website/annotations.py compact \
+  /nfs/hatops/ar0/hatpi-website/keyboard_flags.json /nfs/hatops/ar0/hatpi-website/comments.json >> $log_file 2>&1 \
+  || echo "annotation journal compaction failed" >> $log_file
+
 echo "All steps completed successfully at $(date)" >> $log_file
@@ -1,46 +1,49 @@
 #!/usr/bin/env python3
+"""
+Copy keyboard_flags.json (and comments.json) into the annotations database
+(HATPI_ANNOTATIONS_DB, by default image_flags.db in HATPI_DATA_DIR).
 
-import sqlite3
-import json
+Run this once before switching the website to HATPI_STORAGE_BACKEND=sqlite:
+from then on the database is the primary store and the JSON files are
+no longer written, so syncing again would roll newer flags back. The script
+refuses to do that unless given --force.
+"""
+
+import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotations import AnnotationsDB, SqliteCommentStore, SqliteFlagStore, read_json_store
 
 JSON_FILE = "/nfs/hatops/ar0/hatpi-website/keyboard_flags.json"
-DB_PATH = "/nfs/hatops/ar0/hatpi-website/data/image_flags.db"
+COMMENTS_FILE = "/nfs/hatops/ar0/hatpi-website/comments.json"
+DB_PATH = os.environ.get('HATPI_ANNOTATIONS_DB',
+                         os.path.join(os.environ.get('HATPI_DATA_DIR', '/var/lib/hatpi-website'), 'image_flags.db'))
 
 def main():
-    if not os.path.exists(JSON_FILE):
-        print(f"JSON file not found at {JSON_FILE}. Exiting.")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--force', action='store_true',
+                        help='sync even though the website already uses the database as its store')
+    args = parser.parse_args()
+
+    if os.environ.get('HATPI_STORAGE_BACKEND') == 'sqlite' and not args.force:
+        print("HATPI_STORAGE_BACKEND=sqlite: the database is the primary store. Use --force to overwrite it.")
         return
-    
-    # read the json file
-    with open(JSON_FILE, 'r') as f:
-        data = json.load(f)
-        
-    # open db connection
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Example: if your DB column is actually 'file_path', use that below
-    # If you kept it as 'file_name', then keep "file_name" here instead
-    column_name = "file_path"  # or "file_name" if you didn't rename
-
-    # upsert to DB
-    for file_path, info in data.items():
-        flags_list = info.get("flags", [])
-        flags_str = json.dumps(flags_list)  # store as JSON text
-        timestamp = info.get("timestamp", "")
-        author = info.get("author", "")
-        
-        # "INSERT OR REPLACE" means if the key already exists, it updates the row.
-        sql = f"""
-            INSERT OR REPLACE INTO image_flags ({column_name}, flags, timestamp, author)
-            VALUES (?, ?, ?, ?)
-        """
-        cursor.execute(sql, (file_path, flags_str, timestamp, author))
-        
-    conn.commit()
-    conn.close()
+
+    db = AnnotationsDB(DB_PATH)
+    for path, store in ((JSON_FILE, SqliteFlagStore(db)), (COMMENTS_FILE, SqliteCommentStore(db))):
+        if not os.path.exists(path) and not os.path.exists(path + '.journal'):
+            print(f"JSON file not found at {path}. Skipping.")
+            continue
+        # Snapshot plus journal: writes since the last compaction count too
+        data = read_json_store(path)
+        # Upserts in one transaction; entries already in the DB but not in the JSON are kept
+        count = store.import_json(data)
+        print(f"{path}: {count} entries synced")
+
     print("sync complete")
-    
+
 if __name__ == "__main__":
     main()
@@ -1955,12 +1955,12 @@ function precheckKeyboardFlags(filePath) {
     // Must remove "/hatpi" if that's what you do before saving:
     const pathKey = filePath.replace('/hatpi', '');
 
-    fetch('/hatpi/keyboard_flags.json')
+    // Only this file's entry (a few hundred bytes), not all of keyboard_flags.json
+    fetch('/hatpi/api/keyboard_flags' + encodeURI(pathKey))
         .then(r => r.json())
-        .then(data => {
-            // Now lookup using pathKey instead of fileName
-            if (data[pathKey] && data[pathKey].flags) {
-                const savedFlags = data[pathKey].flags;
+        .then(entry => {
+            if (entry && entry.flags && entry.flags.length) {
+                const savedFlags = entry.flags;
                 // Then check your checkboxes accordingly
                 const checkboxes = document.querySelectorAll('#flags-container .flags-grid input[type="checkbox"]');
                 checkboxes.forEach(cb => {
@@ -2039,7 +2039,7 @@ function submitCommentOrMarkup(filePath, comment, author) {
             .then(data => {
                 if (data.success) {
                     alert('Markups and comment saved successfully!');
-                    loadComments();
+                    refreshAuthorComments(author);
                     resetDrawingOccurred();
                 } else {
                     alert('Failed to save markups and comment.');
@@ -2071,7 +2071,7 @@ function submitCommentOrMarkup(filePath, comment, author) {
             .then(data => {
                 if (data.success) {
                     alert('Comment submitted successfully!');
-                    loadComments();
+                    refreshAuthorComments(author);
                     resetDrawingOccurred();
                 } else {
                     alert('Failed to submit comment.');
@@ -2290,85 +2290,230 @@ function formatTitle(fileName, folderName) {
 }
 
 
-function loadComments() {
-    fetch('/hatpi/comments.json')
+// Local copies of comments.json and keyboard_flags.json. After the first full
+// download they are kept current through /api/changes, which only sends what
+// changed since the version we hold.
+const annotationsCache = {
+    comments: { url: '/hatpi/comments.json', data: null, version: null },
+    flags: { url: '/hatpi/keyboard_flags.json', data: null, version: null }
+};
+
+function syncAnnotations(store) {
+    const entry = annotationsCache[store];
+    if (!entry.data || !entry.version) {
+        return fetch(entry.url)
+            .then(response => {
+                entry.version = response.headers.get('X-Annotations-Version');
+                return response.json();
+            })
+            .then(data => (entry.data = data));
+    }
+    return fetch(`/hatpi/api/changes?store=${store}&since=${encodeURIComponent(entry.version)}`)
         .then(response => response.json())
-        .then(data => {
-            const commentsContainer = document.querySelector('.comments-container');
-            if (!commentsContainer) return;
-            commentsContainer.innerHTML = '';
-
-            // Convert the object of comments into an array
-            const commentsArray = Object.entries(data).map(([key, comment]) => ({
-                ...comment,
-                uniqueKey: key
-            }));
-            // Sort by newest first
-            commentsArray.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
-
-            for (const comment of commentsArray) {
-                // 1) Get the filename from comment.file_path:
-                const rawFilename = comment.file_path.split('/').pop();
-
-                // 2) Check if path includes '/RED/' or '/SUB/'
-                let prettyName;
-                if (comment.file_path.includes('/RED/') || comment.file_path.includes('/SUB/')) {
-                    // Just show the raw filename for RED/SUB:
-                    prettyName = rawFilename;
-                } else {
-                    // For calibration files, keep using your existing formatTitle() logic:
-                    const lines = formatTitle(rawFilename);
-                    prettyName = lines.join(' | ');
-                }
+        .then(result => {
+            const delta = result[store];
+            if (delta.reset) {
+                entry.data = delta.changed;
+            } else {
+                Object.assign(entry.data, delta.changed);
+                delta.deleted.forEach(key => delete entry.data[key]);
+            }
+            entry.version = result.version;
+            return entry.data;
+        });
+}
 
-                // 3) Build the comment DOM:
-                const iconDiv = document.createElement('div');
-                iconDiv.className = 'markup-icon';
-                iconDiv.innerText = comment.markup_true || '';
-
-                const commentItem = document.createElement('div');
-                commentItem.className = 'comment-item';
-                commentItem.setAttribute('data-comment-id', comment.uniqueKey);
-                commentItem.innerHTML = `
-                    <div class="comment-header">
-                        <span class="comment-filename">
-                            <a href="${comment.file_path}" target="_blank">
-                                ${prettyName}
-                            </a>
-                        </span>
-                        <span class="comment-timestamp">${comment.timestamp}</span>
-                    </div>
-                    <div class="comment-body">
-                        <p>${comment.comment}</p>
-                        <button class="delete-comment-button" onclick="deleteComment('${comment.uniqueKey}')">
-                            Delete
-                        </button>
-                    </div>
-                `;
+/**
+ * Re-render one author's card on the home page with their newest page of
+ * comments (after a post or delete), leaving the other cards and their
+ * "Show more" state as they are. Adds the card for a new author and drops
+ * it when the author has no comments left. No-op off the home page.
+ */
+function refreshAuthorComments(author) {
+    const container = document.querySelector('.comments-container');
+    if (!container) return;
+    author = author || 'Unknown';
 
-                // 4) Insert the "markup icon" if any:
-                const filenameElement = commentItem.querySelector('.comment-filename');
-                filenameElement.insertBefore(iconDiv, filenameElement.firstChild);
-
-                // 5) If you also want to show flags, do something like:
-                if (comment.flags && comment.flags.length) {
-                    const flagsContainer = document.createElement('div');
-                    flagsContainer.className = 'comment-flags';
-                    comment.flags.forEach(flag => {
-                        const flagSpan = document.createElement('span');
-                        flagSpan.className = 'flag';
-                        flagSpan.innerText = flag;
-                        flagsContainer.appendChild(flagSpan);
-                    });
-                    commentItem.querySelector('.comment-body').appendChild(flagsContainer);
-                }
+    const url = new URL('/hatpi/api/comments', window.location.origin);
+    url.searchParams.set('author', author);
+    url.searchParams.set('limit', container.dataset.pageSize || 10);
 
-                commentsContainer.appendChild(commentItem);
+    fetch(url.toString())
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
             }
+            return response.json();
+        })
+        .then(data => {
+            const cards = Array.from(container.querySelectorAll('.comment-card'));
+            const card = cards.find(c => c.dataset.author === author);
+            if (!data.total) {
+                if (card) card.remove();
+                return;
+            }
+            const newCard = buildCommentCard(author, data);
+            if (card) {
+                card.replaceWith(newCard);
+            } else {
+                // Cards are sorted by author, as the template renders them
+                const next = cards.find(c => c.dataset.author > author);
+                container.insertBefore(newCard, next || null);
+            }
+            const button = newCard.querySelector('.load-more-comments');
+            if (button) observeCommentPaging(button);
         })
         .catch(error => console.error('Error loading comments:', error));
 }
 
+/**
+ * Build an author's home page card from an /api/comments page
+ * (same markup as the index.html loop).
+ */
+function buildCommentCard(author, page) {
+    const card = document.createElement('div');
+    card.className = 'comment-card';
+    card.dataset.author = author;
+
+    const header = document.createElement('div');
+    header.className = 'card-header';
+    const title = document.createElement('h3');
+    title.textContent = author;
+    header.appendChild(title);
+
+    const body = document.createElement('div');
+    body.className = 'card-body';
+    (page.items || []).forEach(item => body.appendChild(buildCommentItem(item)));
+    if (page.has_more) {
+        const button = document.createElement('button');
+        button.className = 'load-more-comments';
+        button.dataset.author = author;
+        button.dataset.cursor = page.next_cursor;
+        button.textContent = `Show more (${page.total - (page.items || []).length})`;
+        button.addEventListener('click', () => loadMoreComments(button));
+        body.appendChild(button);
+    }
+    card.append(header, body);
+    return card;
+}
+
+
+
+/**
+ * Build one home page comment item from an /api/comments entry
+ * (same markup as the index.html loop).
+ */
+function buildCommentItem(item) {
+    const commentItem = document.createElement('div');
+    commentItem.className = 'comment-item';
+    commentItem.setAttribute('data-comment-id', item.unique_key);
+
+    const header = document.createElement('div');
+    header.className = 'comment-header';
+    if (item.markup_true) {
+        const iconDiv = document.createElement('div');
+        iconDiv.className = 'markup-icon';
+        iconDiv.innerText = item.markup_true;
+        header.appendChild(iconDiv);
+    }
+    const filename = document.createElement('span');
+    filename.className = 'comment-filename';
+    const link = document.createElement('a');
+    link.href = item.file_path;
+    link.target = '_blank';
+    link.textContent = item.display_name;
+    filename.appendChild(link);
+    const timestamp = document.createElement('span');
+    timestamp.className = 'comment-timestamp';
+    timestamp.textContent = item.timestamp;
+    header.append(filename, timestamp);
+
+    const body = document.createElement('div');
+    body.className = 'comment-body';
+    const text = document.createElement('p');
+    text.textContent = item.comment;
+    const deleteButton = document.createElement('button');
+    deleteButton.className = 'delete-comment-button';
+    deleteButton.textContent = 'Delete';
+    deleteButton.addEventListener('click', () => deleteComment(item.unique_key));
+    body.append(text, deleteButton);
+    commentItem.append(header, body);
+
+    if (item.flags && item.flags.length) {
+        const flagsContainer = document.createElement('div');
+        flagsContainer.className = 'comment-flags';
+        item.flags.forEach(flag => {
+            const flagSpan = document.createElement('span');
+            flagSpan.className = 'flag';
+            flagSpan.innerText = flag;
+            flagsContainer.appendChild(flagSpan);
+        });
+        commentItem.appendChild(flagsContainer);
+    }
+    return commentItem;
+}
+
+/**
+ * Fetch the next page of an author's comments into their card
+ * (the "Show more" button carries the author and cursor).
+ */
+function loadMoreComments(button) {
+    if (button.dataset.loading) return;
+    button.dataset.loading = '1';
+
+    const url = new URL('/hatpi/api/comments', window.location.origin);
+    url.searchParams.set('author', button.dataset.author);
+    url.searchParams.set('cursor', button.dataset.cursor);
+
+    fetch(url.toString())
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            (data.items || []).forEach(item => {
+                button.parentNode.insertBefore(buildCommentItem(item), button);
+            });
+            if (data.has_more) {
+                const shown = button.parentNode.querySelectorAll('.comment-item').length;
+                button.dataset.cursor = data.next_cursor;
+                button.textContent = `Show more (${data.total - shown})`;
+            } else {
+                button.remove();
+            }
+        })
+        .catch(error => console.error('Error loading comments:', error))
+        .finally(() => { delete button.dataset.loading; });
+}
+
+/**
+ * Load the next page when a card is scrolled to its "Show more" button.
+ */
+function setupCommentPaging() {
+    document.querySelectorAll('.comment-card .load-more-comments').forEach(observeCommentPaging);
+}
+
+function observeCommentPaging(button) {
+    if (!('IntersectionObserver' in window)) return;
+    const io = new IntersectionObserver((entries) => {
+        entries.forEach(entry => {
+            if (!entry.isIntersecting) return;
+            if (!entry.target.isConnected) {
+                io.disconnect();
+                return;
+            }
+            loadMoreComments(entry.target);
+        });
+    }, {
+        root: button.closest('.card-body'),
+        rootMargin: '100px',
+        threshold: 0.01
+    });
+    io.observe(button);
+}
+
 
 
 /**
@@ -2392,7 +2537,10 @@ function deleteComment(commentId) {
                 if (data.success) {
                     const commentElement = document.querySelector(`.comment-item[data-comment-id='${commentId}']`);
                     if (commentElement) {
+                        const card = commentElement.closest('.comment-card');
                         commentElement.remove();
+                        // Pull the next comment up and fix the "Show more" count
+                        if (card) refreshAuthorComments(card.dataset.author);
                     }
                 } else {
                     alert('Failed to delete comment.');
@@ -2935,8 +3083,7 @@ function formatTaggedFileName(filePath) {
 }
 
 function loadTaggedImages() {
-    fetch('/hatpi/keyboard_flags.json')
-        .then(response => response.json())
+    syncAnnotations('flags')
         .then(data => {
             // Group entries by flag
             const groups = {};
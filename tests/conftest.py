@@ -0,0 +1,69 @@
+"""
+Point app.py at a small website tree under a temp directory. app.py reads
+its paths when imported, so the tree and the environment are set up here,
+before any test module imports it.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp(prefix='hatpi-tests-')
+BASE_DIR = os.path.join(TMP, 'site')
+NIGHT = '1-20250216'
+RED_FRAMES = ['1-4879%02d_50-red-object-bin4.jpg' % n for n in range(18, 23)]
+
+
+def touch(path, data=b'x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_site():
+    night = os.path.join(BASE_DIR, NIGHT)
+    for ihu in ('01', '02', '50'):
+        touch(os.path.join(night, 'ihu-%s-masterflat-%s-ss.jpg' % (ihu, NIGHT)))
+        touch(os.path.join(night, '%s_%s_calframe_quality.html' % (NIGHT, ihu)))
+        touch(os.path.join(night, '%s_%s_subframe_movie.mp4' % (NIGHT, ihu)))
+    for product in ('RED', 'SUB'):
+        for name in RED_FRAMES:
+            touch(os.path.join(BASE_DIR, product, NIGHT, 'ihu50', name.replace('-red-', '-%s-' % product.lower())))
+        os.makedirs(os.path.join(BASE_DIR, product, '1-20250217', 'ihu01'))
+    os.makedirs(os.path.join(BASE_DIR, 'ihu-01'))
+    for name in ('comments.json', 'keyboard_flags.json'):
+        touch(os.path.join(BASE_DIR, name), b'{}')
+
+
+build_site()
+os.environ.update({
+    'HATPI_BASE_DIR': BASE_DIR,
+    'HATPI_CACHE_DIR': os.path.join(TMP, 'cache'),
+    'HATPI_DATA_DIR': os.path.join(TMP, 'data'),
+    'HATPI_STORAGE_BACKEND': 'json',
+})
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TMP, ignore_errors=True)
+
+
+@pytest.fixture
+def app_module():
+    """app.py with empty in-process caches, so tests don't see each other's listings."""
+    import app
+    for cache in (app.cache, app.resolved_paths, app.compressed_responses):
+        cache.clear()
+    app.shared_cache.clear()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,143 @@
+import json
+import random
+
+from annotations import CommentStore, FlagStore, JsonFileStore, read_json_store
+
+
+def make_store(tmp_path, data=None, cls=JsonFileStore, **kwargs):
+    path = tmp_path / 'store.json'
+    if data is not None:
+        path.write_text(json.dumps(data))
+    kwargs.setdefault('fsync', 'never')
+    store = cls(str(path), **kwargs)
+    store.refresh()
+    return store
+
+
+def journal_lines(store):
+    with open(store.journal_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_writes_go_to_the_journal_not_the_snapshot(tmp_path):
+    store = make_store(tmp_path, {'a': 1})
+    store.write([('set', 'b', 2), ('del', 'a'), ('del', 'missing')])
+
+    assert store.data == {'b': 2}
+    assert json.loads(open(store.path).read()) == {'a': 1}
+    assert [(e['op'], e['key'], e['seq']) for e in journal_lines(store)] == [('set', 'b', 1), ('del', 'a', 2)]
+    assert store.version == 2
+
+
+def test_other_instances_replay_the_journal(tmp_path):
+    writer = make_store(tmp_path, {'a': 1})
+    reader = make_store(tmp_path)
+    writer.write([('set', 'b', 2)])
+    reader.refresh()
+    writer.write([('del', 'a')])
+    reader.refresh()
+
+    assert reader.data == {'b': 2}
+    assert reader.version == writer.version == 2
+    assert read_json_store(writer.path) == {'b': 2}
+
+
+def test_half_written_line_waits_for_the_rest(tmp_path):
+    store = make_store(tmp_path, {})
+    store.write([('set', 'a', 1)])
+    with open(store.journal_path, 'ab') as f:
+        f.write(b'{"op": "set", "key": "b", "va')
+    reader = make_store(tmp_path)
+    assert reader.data == {'a': 1}
+
+    # The next writer ends the torn line so its own entry parses
+    store.write([('set', 'c', 3)])
+    reader.refresh()
+    assert reader.data == {'a': 1, 'c': 3}
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    store = make_store(tmp_path, {'a': 1})
+    store.write([('set', 'b', 2), ('del', 'a')])
+    store.compact()
+
+    assert json.loads(open(store.path).read()) == {'b': 2}
+    assert journal_lines(store) == [{'op': 'base', 'seq': 2}]
+    fresh = make_store(tmp_path)
+    assert (fresh.data, fresh.version) == ({'b': 2}, 2)
+
+    # Versions keep counting up across compactions
+    store.write([('set', 'c', 3)])
+    fresh.refresh()
+    assert (fresh.data, fresh.version) == ({'b': 2, 'c': 3}, 3)
+
+
+def test_compacts_itself_past_compact_bytes(tmp_path):
+    store = make_store(tmp_path, {}, compact_bytes=200)
+    for i in range(10):
+        store.write([('set', 'k%d' % i, 'x' * 20)])
+
+    assert len(json.loads(open(store.path).read())) >= 5
+    assert make_store(tmp_path).data == store.data
+
+
+def test_changes_since(tmp_path):
+    store = make_store(tmp_path, {'a': 1, 'b': 2})
+    store.write([('set', 'c', 3)])
+    version = store.version
+    store.write([('set', 'a', 10), ('del', 'b')])
+
+    changes = store.changes_since(version)
+    assert changes == {'version': 3, 'reset': False, 'changed': {'a': 10}, 'deleted': ['b']}
+    assert store.changes_since(store.version)['changed'] == {}
+
+    store.compact()
+    store.write([('set', 'd', 4)])
+    assert store.changes_since(store.version - 1)['changed'] == {'d': 4}
+    reset = store.changes_since(version)
+    assert reset['reset'] and reset['changed'] == {'a': 10, 'c': 3, 'd': 4}
+
+
+def comment_indexes(store):
+    return (list(store.comments.items()), store.by_author, store.by_path, store.by_folder, store.by_ihu,
+            store.timeline, list(store._grouped.items()), store.commented, store.counts)
+
+
+def test_comment_indexes_follow_writes(tmp_path):
+    store = make_store(tmp_path, {}, cls=CommentStore)
+    paths = ['/hatpi/RED/1-20250216/ihu50/f%d.jpg', '/hatpi/ihu-01/g%d.jpg',
+             '/hatpi/markup_images/m%d.png', '/hatpi/1-20250217/x_%02d_q.html']
+    rng = random.Random(7)
+    for i in range(200):
+        # Mostly newest-first additions, with some back-dated ones and edits
+        second = i if rng.random() < 0.8 else rng.randrange(i + 1)
+        timestamp = '2026-01-01 00:%02d:%02d' % divmod(second, 60)
+        roll = rng.random()
+        if roll < 0.6 or not store.data:
+            comment = {'file_path': rng.choice(paths) % rng.randrange(4), 'comment': 'c',
+                       'timestamp': timestamp, 'author': rng.choice(['A', 'B', None, ''])}
+            ops = [('set', 'k%d' % i, comment)]
+        elif roll < 0.85:
+            ops = [('del', rng.choice(list(store.data)))]
+        else:
+            key = rng.choice(list(store.data))
+            ops = [('set', key, dict(store.data[key], author='C'))]
+        store.write(ops)
+
+        rebuilt = CommentStore.__new__(CommentStore)
+        rebuilt.data = store.data
+        rebuilt._index()
+        assert comment_indexes(store) == comment_indexes(rebuilt), i
+    assert store.author_counts().get('Unknown')
+
+
+def test_flag_counts_follow_writes(tmp_path):
+    store = make_store(tmp_path, {}, cls=FlagStore)
+    path = '/RED/1-20250216/ihu50/1-487920_50-red-object-bin4.jpg'
+    store.set_flags(path, ['T', 'X'], '2026-01-01 00:00:00', 'A')
+    assert sorted(store.flag_counts()) == [('1-20250216', 50, 'T', 1), ('1-20250216', 50, 'X', 1)]
+    assert len(store.for_folder('RED/1-20250216')) == 1
+
+    store.set_flags(path, [], '2026-01-01 00:00:01', 'A')
+    assert store.flag_counts() == []
+    assert store.for_folder('RED/1-20250216') == []
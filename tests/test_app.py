@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+
+from conftest import BASE_DIR, NIGHT, RED_FRAMES
+
+IHU50 = 'RED/%s/ihu50' % NIGHT
+
+
+def add_file(folder, name):
+    """Add a file the way an ingest run does: new folder mtime, then mark_changed."""
+    import app
+    path = os.path.join(BASE_DIR, folder)
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(b'x')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    app.invalidate_folders([path])
+
+
+def test_folder_listing_revalidates_until_the_folder_changes(client):
+    first = client.get('/api/folder/%s' % NIGHT)
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+    assert len(json.loads(first.data)['images']) == 3
+
+    again = client.get('/api/folder/%s' % NIGHT, headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b''
+    # Other query parameters are other responses
+    assert client.get('/api/folder/%s?limit=1' % NIGHT, headers={'If-None-Match': etag}).status_code == 200
+
+    add_file(NIGHT, 'ihu-03-masterflat-%s-ss.jpg' % NIGHT)
+    changed = client.get('/api/folder/%s' % NIGHT, headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert len(json.loads(changed.data)['images']) == 4
+
+
+def test_streamed_listing_is_compressed(client):
+    plain = client.get('/api/folder/%s' % IHU50)
+    assert plain.is_streamed and 'Content-Encoding' not in plain.headers
+
+    response = client.get('/api/folder/%s' % IHU50, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert 'Content-Length' not in response.headers
+    assert gzip.decompress(response.data) == plain.data
+    etag = response.headers['ETag']
+    assert etag == 'W/' + plain.headers['ETag']
+
+    again = client.get('/api/folder/%s' % IHU50, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+
+
+def test_cursor_pages_cover_the_folder(client):
+    url = '/api/folder/%s?kind=images&sort=frame&order=desc&limit=2&cursor=' % IHU50
+    names, cursor = [], ''
+    while True:
+        page = client.get(url + cursor).get_json()
+        names += [name for name, _ in page['items']]
+        if not page['has_more']:
+            break
+        cursor = page['next_cursor']
+    assert names == sorted(RED_FRAMES, reverse=True)
+
+    page = client.get(url).get_json()
+    other_sort = '/api/folder/%s?kind=images&sort=name&order=desc&cursor=%s' % (IHU50, page['next_cursor'])
+    response = client.get(other_sort)
+    assert response.status_code == 400 and 'error' in response.get_json()
+
+
+def test_subfolder_counts_etag_follows_the_subfolders(client):
+    url = '/api/subfolders/RED?counts=1'
+    first = client.get(url)
+    assert first.get_json()['counts']['1-20250217'] == {'files': 0, 'subfolders': 1}
+    etag = first.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    # RED's own mtime doesn't move when a night inside it gains a file
+    red_mtime = os.stat(os.path.join(BASE_DIR, 'RED')).st_mtime
+    add_file('RED/1-20250217', 'notes.html')
+    assert os.stat(os.path.join(BASE_DIR, 'RED')).st_mtime == red_mtime
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert changed.get_json()['counts']['1-20250217'] == {'files': 1, 'subfolders': 1}
+
+    response = client.get('/api/subfolders/RED?from=2025-02-17')
+    assert response.get_json()['subfolders'] == ['1-20250217']
+    assert client.get('/api/subfolders/RED?from=junk').status_code == 400
+
+
+def test_changes_feed(client):
+    version = client.get('/api/changes?since=0').get_json()['version']
+    path = '/RED/%s/ihu50/%s' % (NIGHT, RED_FRAMES[0])
+
+    assert client.post('/api/keyboard_flags', json={'filePath': path, 'flags': ['X', 'T', 'X']}).get_json()['flags'] == ['T', 'X']
+    body = client.get('/api/changes?since=%s' % version).get_json()
+    assert body['flags']['changed'][path]['flags'] == ['T', 'X']
+    assert body['comments']['changed'] == {} and not body['flags']['reset']
+    assert body['version'] != version
+
+    version = body['version']
+    client.post('/api/keyboard_flags', json={'filePath': path, 'flags': []})
+    client.post('/submit_comment', json={'fileName': RED_FRAMES[0], 'filePath': '/hatpi' + path,
+                                          'comment': 'streak', 'author': 'A'})
+    body = client.get('/api/changes?since=%s' % version).get_json()
+    assert body['flags']['deleted'] == [path]
+    assert [c['comment'] for c in body['comments']['changed'].values()] == ['streak']
+
+    flags_only = client.get('/api/changes?since=%s&store=flags' % version).get_json()
+    assert 'comments' not in flags_only and flags_only['version'].split('.')[0] == version.split('.')[0]
+
+    for since in ('', 'abc', '1.2.3', '-1'):
+        assert client.get('/api/changes?since=%s' % since).status_code == 400
+    assert client.get('/api/changes?since=0&store=other').status_code == 400
+
+
+def test_annotation_json_revalidates(client):
+    first = client.get('/hatpi/keyboard_flags.json')
+    etag = first.headers['ETag']
+    assert client.get('/hatpi/keyboard_flags.json', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/api/keyboard_flags', json={'filePath': '/SUB/%s/ihu50/x.jpg' % NIGHT, 'flags': ['T']})
+    assert client.get('/hatpi/keyboard_flags.json', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_flag_endpoints_reject_bad_bodies(client):
+    for url in ('/api/keyboard_flags/lookup', '/api/keyboard_flags/batch'):
+        assert client.post(url, json=['not', 'an', 'object']).status_code == 400
+        assert client.post(url, data='{', content_type='application/json').status_code == 400
+    assert client.post('/api/keyboard_flags/lookup', json={'paths': 'x'}).status_code == 400
+    assert client.post('/api/keyboard_flags', json={'flags': ['T']}).status_code == 400
+
+
+def test_warmup_needs_a_local_request_with_the_token(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'start_cache_warmup', lambda reason: True)
+    token = app_module.warmup_token()
+    assert oct(os.stat(app_module.WARMUP_TOKEN_FILE).st_mode & 0o777) == '0o640'
+
+    assert client.post('/api/warmup', headers={'X-Warmup-Token': token}).get_json()['started']
+    assert client.post('/api/warmup').status_code == 403
+    assert client.post('/api/warmup', headers={'X-Warmup-Token': 'wrong'}).status_code == 403
+    proxied = {'X-Warmup-Token': token, 'X-Forwarded-For': '203.0.113.9'}
+    assert client.post('/api/warmup', headers=proxied).status_code == 403
+    remote = client.post('/api/warmup', headers={'X-Warmup-Token': token},
+                         environ_base={'REMOTE_ADDR': '203.0.113.9'})
+    assert remote.status_code == 403
+    assert client.get('/api/warmup').status_code == 200
@@ -0,0 +1,74 @@
+import pytest
+
+from app import (SizedTTLCache, approx_size, decode_cursor, decode_listing_cursor,
+                 encode_cursor)
+
+
+def test_lookup_fresh_stale_and_expired():
+    cache = SizedTTLCache()
+    cache.put('fresh', 1, ttl=60)
+    cache.put('stale', 2, ttl=0, stale_ttl=60)
+    cache.put('gone', 3, ttl=0)
+
+    assert cache.lookup('fresh') == (1, 'fresh')
+    assert cache.lookup('stale') == (2, 'stale')
+    assert cache.lookup('gone') == (None, None)
+    assert cache.lookup('missing') == (None, None)
+    # get() only answers with fresh entries; the expired one is dropped
+    assert cache.get('stale') is None
+    assert 'gone' not in cache.keys()
+    stats = cache.stats()
+    assert (stats['hits'], stats['stale_hits'], stats['expirations']) == (1, 2, 1)
+
+
+def test_evicts_least_recently_used_past_max_bytes():
+    value = 'x' * 1000
+    entry = approx_size('a') + approx_size(value)
+    cache = SizedTTLCache(max_bytes=int(entry * 2.5))
+    cache.put('a', value)
+    cache.put('b', value)
+    cache.lookup('a')
+    cache.put('c', value)
+
+    assert sorted(cache.keys()) == ['a', 'c']
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+
+def test_put_replaces_and_pop_releases_bytes():
+    cache = SizedTTLCache()
+    cache.put('k', 'old')
+    cache.put('k', 'newer value')
+    assert cache.get('k') == 'newer value'
+    assert cache.pop('k') == 'newer value'
+    assert cache.stats()['bytes'] == 0
+    assert cache.pop('k') is None
+
+
+def test_cursor_round_trip():
+    key = ('images', 'frame', 'desc', 487920, '1-487920_50-red-object-bin4.jpg')
+    cursor = encode_cursor(key)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == key
+    assert decode_listing_cursor(cursor, 'images', 'frame', 'desc') == key[3:]
+
+
+@pytest.mark.parametrize('kind, sort, order', [
+    ('movies', 'frame', 'desc'),
+    ('images', 'date', 'desc'),
+    ('images', 'frame', 'asc'),
+])
+def test_listing_cursor_rejects_other_requests(kind, sort, order):
+    cursor = encode_cursor(('images', 'frame', 'desc', 487920, 'x.jpg'))
+    with pytest.raises(ValueError):
+        decode_listing_cursor(cursor, kind, sort, order)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64 json!',
+    encode_cursor(('images', 'frame', 'desc', 'not-a-number', 'x.jpg')),
+    encode_cursor(('images', 'frame', 'desc', 1)),
+])
+def test_listing_cursor_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        decode_listing_cursor(cursor, 'images', 'frame', 'desc')